@@ -0,0 +1,309 @@
+"""
+Import pipeline shared by the CSV import and the bulk JSON/NDJSON endpoints.
+
+Rows are validated into plain dicts, de-duplicated on (company, year, sector)
+and then written with a single lookup query plus bulk create/update calls,
+followed by the derived metrics stage (see dashboard.metrics). Problems found
+while validating are collected in an ImportReport.
+"""
+import math
+from collections import Counter
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import BULK_BATCH_SIZE, ChangeSequence, EmissionRecord
+from .metrics import refresh_metrics
+from .csv_config import FIELD_PARSERS
+
+# Model fields every imported record must provide
+RECORD_FIELDS = ('company', 'year', 'sector', 'energy_consumption_mwh', 'co2_emissions_tons')
+
+# Fields written when an existing record is updated
+UPDATE_FIELDS = ['energy_consumption_mwh', 'co2_emissions_tons', 'sequence', 'updated_at']
+
+# Number of errors returned in full in a response, the rest are only counted
+ERROR_SAMPLE_SIZE = 100
+
+# Error codes of the ImportReport
+MISSING_FIELD = 'missing_field'
+INVALID_FORMAT = 'invalid_format'
+DUPLICATE = 'duplicate'
+INVALID_JSON = 'invalid_json'
+INVALID_RECORD = 'invalid_record'
+UNEXPECTED = 'unexpected'
+
+# Codes of problems an import resolves on its own (the row is still imported)
+WARNING_CODES = (DUPLICATE,)
+
+
+class MissingFieldError(ValueError):
+    """Raised when a record lacks a value for one of the RECORD_FIELDS"""
+
+    def __init__(self, message="Missing required fields", field=None):
+        super().__init__(message)
+        self.field = field
+
+
+class InvalidFieldError(ValueError):
+    """Raised when the value of one of the RECORD_FIELDS can not be parsed"""
+
+    def __init__(self, message, field=None):
+        super().__init__(message)
+        self.field = field
+
+
+class ImportReport:
+    """
+    Errors found while validating an import.
+
+    Every error is counted per code, but only the first sample_size errors are
+    kept, so a file full of bad rows does not produce an unbounded response.
+    Errors are also passed to sink (if set), e.g. to stream the full report.
+    Once max_errors errors were found the report is marked as aborted and
+    callers stop reading rows.
+    """
+
+    def __init__(self, label='Row', columns=None, max_errors=None, sample_size=ERROR_SAMPLE_SIZE, sink=None):
+        self.label = label
+        self.columns = columns or {}  # model field -> column name in the source file
+        self.max_errors = max_errors
+        self.sample_size = sample_size
+        self.sink = sink
+        self.counts = Counter()
+        self.samples = []
+        self.aborted = False
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    @property
+    def warnings(self):
+        return sum(self.counts[code] for code in WARNING_CODES)
+
+    def add(self, row, code, message, field=None):
+        error = {
+            'row': row,
+            'column': self.columns.get(field, field),
+            'code': code,
+            'message': message,
+        }
+        self.counts[code] += 1
+        if len(self.samples) < self.sample_size:
+            self.samples.append(error)
+        if self.sink is not None:
+            self.sink(error)
+        if self.max_errors is not None and self.total >= self.max_errors:
+            self.aborted = True
+
+    def add_exception(self, row, error):
+        """Log an exception raised while parsing a row"""
+        if isinstance(error, MissingFieldError):
+            self.add(row, MISSING_FIELD, str(error), error.field)
+        elif isinstance(error, ValueError):
+            self.add(row, INVALID_FORMAT, f"Invalid data format - {error}", getattr(error, 'field', None))
+        else:
+            self.add(row, UNEXPECTED, str(error))
+
+    def messages(self):
+        """Sampled errors in the "Row N: message" form of the errors list"""
+        return [f"{self.label} {error['row']}: {error['message']}" for error in self.samples]
+
+
+def record_key(row_data):
+    """Unique key of a record, mirrors EmissionRecord.Meta.unique_together"""
+    return (row_data['company'], row_data['year'], row_data['sector'])
+
+
+def parse_record(row_data, row_num):
+    """
+    Convert raw field values into typed values using FIELD_PARSERS.
+    Values that are already numbers (e.g. coming from JSON) are accepted as is.
+    Raises MissingFieldError if a field is empty and InvalidFieldError if a
+    value can not be parsed.
+    """
+    parsed_data = {'row_num': row_num}
+    for field in RECORD_FIELDS:
+        value = row_data.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            raise MissingFieldError(field=field)
+
+        parser = FIELD_PARSERS.get(field)
+        if parser is None:
+            # Text fields only take text, like the ViewSet's serializer
+            if not isinstance(value, str):
+                raise InvalidFieldError(f"{field} must be a string, got {value!r}", field)
+            parsed_data[field] = value
+        elif isinstance(value, bool):
+            raise InvalidFieldError(f"invalid value for {field}: {value!r}", field)
+        elif isinstance(value, (int, float)):
+            if field == 'year' and value != int(value):
+                raise InvalidFieldError(f"invalid literal for int(): {value!r}", field)
+            parsed_data[field] = int(value) if field == 'year' else float(value)
+        else:
+            try:
+                parsed_data[field] = parser(str(value))
+            except ValueError as e:
+                raise InvalidFieldError(str(e), field) from e
+        check_field_limits(field, parsed_data[field])
+    return parsed_data
+
+
+def check_field_limits(field, value):
+    """
+    Raise InvalidFieldError if a parsed value can not be stored in its model
+    field, so a bad record is rejected on its own instead of failing the batch
+    """
+    model_field = EmissionRecord._meta.get_field(field)
+    if isinstance(value, str):
+        if len(value) > model_field.max_length:
+            raise InvalidFieldError(f"{field} is longer than {model_field.max_length} characters", field)
+    elif isinstance(value, float):
+        if not math.isfinite(value):
+            raise InvalidFieldError(f"{field} must be a finite number, got {value!r}", field)
+        limit = 10 ** (model_field.max_digits - model_field.decimal_places)
+        if abs(round(value, model_field.decimal_places)) >= limit:
+            raise InvalidFieldError(f"{field} must be less than {limit}", field)
+    else:
+        low, high = connection.ops.integer_field_range(model_field.get_internal_type())
+        if not low <= value <= high:
+            raise InvalidFieldError(f"{field} out of range: {value}", field)
+
+
+def record_total(parsed_data):
+    """Total impact (emissions + energy) used to pick between duplicate rows"""
+    return float(parsed_data['co2_emissions_tons']) + float(parsed_data['energy_consumption_mwh'])
+
+
+def add_parsed_row(parsed_rows, parsed_data, report, keep_rows=True):
+    """
+    Add a parsed row to parsed_rows (dict keyed by record_key), resolving
+    duplicates by keeping the row with the highest emissions + energy total.
+    On equal totals the first row is kept. Conflicts are logged in report.
+    Without keep_rows only a (row_num, total) pair is kept per key, enough to
+    validate a file without holding all of its rows in memory.
+    """
+    unique_key = record_key(parsed_data)
+    row_num = parsed_data['row_num']
+    new_total = record_total(parsed_data)
+    entry = parsed_data if keep_rows else (row_num, new_total)
+
+    if unique_key not in parsed_rows:
+        parsed_rows[unique_key] = entry
+        return
+
+    existing_row = parsed_rows[unique_key]
+    if keep_rows:
+        existing_row_num, existing_total = existing_row['row_num'], record_total(existing_row)
+    else:
+        existing_row_num, existing_total = existing_row
+
+    label = report.label.lower()
+    duplicate = (
+        f"Duplicate entry for {parsed_data['company']} "
+        f"(year {parsed_data['year']}, sector {parsed_data['sector']})."
+    )
+    # Keep the row with highest total impact (emissions + energy)
+    if new_total > existing_total:
+        report.add(
+            existing_row_num,
+            DUPLICATE,
+            f"{duplicate} Keeping {label} {row_num} with higher emissions/energy values "
+            f"(new total: {new_total:.2f} vs existing: {existing_total:.2f})"
+        )
+        parsed_rows[unique_key] = entry
+    else:
+        report.add(
+            row_num,
+            DUPLICATE,
+            f"{duplicate} Keeping {label} {existing_row_num} with higher emissions/energy values "
+            f"(existing total: {existing_total:.2f} vs new: {new_total:.2f})"
+        )
+
+
+def add_row(parsed_rows, row_data, row_num, report, keep_rows=True):
+    """Parse one raw row into parsed_rows, logging any problem with it in report"""
+    if not isinstance(row_data, dict):
+        report.add(row_num, INVALID_RECORD, "Expected an object")
+        return
+    try:
+        add_parsed_row(parsed_rows, parse_record(row_data, row_num), report, keep_rows)
+    except Exception as e:
+        report.add_exception(row_num, e)
+
+
+def upsert_records(parsed_rows_list):
+    """
+    Create new records and update existing ones whose values changed.
+    Returns a (created_count, updated_count) tuple.
+    """
+    records_to_create = []
+    records_to_update = []
+    existing_records = {}
+
+    # Use transaction for atomicity
+    with transaction.atomic():
+        # Get existing records for comparison
+        existing_records_qs = EmissionRecord.objects.filter(
+            company__in={row['company'] for row in parsed_rows_list},
+            year__in={row['year'] for row in parsed_rows_list},
+            sector__in={row['sector'] for row in parsed_rows_list}
+        )
+
+        # Create a lookup dict for existing records
+        for record in existing_records_qs:
+            existing_records[record.unique_key] = record
+
+        # Separate into create and update operations
+        for row_data in parsed_rows_list:
+            key = record_key(row_data)
+
+            if key in existing_records:
+                # Update existing record only if values are different
+                existing_record = existing_records[key]
+                needs_update = (
+                    float(existing_record.energy_consumption_mwh) != float(row_data['energy_consumption_mwh']) or
+                    float(existing_record.co2_emissions_tons) != float(row_data['co2_emissions_tons'])
+                )
+                if needs_update:
+                    existing_record.energy_consumption_mwh = row_data['energy_consumption_mwh']
+                    existing_record.co2_emissions_tons = row_data['co2_emissions_tons']
+                    records_to_update.append(existing_record)
+            else:
+                # Create new record
+                records_to_create.append(EmissionRecord(
+                    company=row_data['company'],
+                    year=row_data['year'],
+                    sector=row_data['sector'],
+                    energy_consumption_mwh=row_data['energy_consumption_mwh'],
+                    co2_emissions_tons=row_data['co2_emissions_tons']
+                ))
+
+        # Stamp every written record with its own change feed sequence number
+        written_records = records_to_create + records_to_update
+        if written_records:
+            last_sequence = ChangeSequence.reserve(len(written_records))
+            now = timezone.now()
+            for sequence, record in enumerate(written_records, start=last_sequence - len(written_records) + 1):
+                record.sequence = sequence
+                record.updated_at = now
+
+        # Perform bulk operations
+        if records_to_create:
+            EmissionRecord.objects.bulk_create(records_to_create, batch_size=BULK_BATCH_SIZE)
+
+        if records_to_update:
+            EmissionRecord.objects.bulk_update(
+                records_to_update,
+                UPDATE_FIELDS,
+                batch_size=BULK_BATCH_SIZE
+            )
+
+        # Derived metrics stage, only for the series touched by this write
+        refresh_metrics(
+            [record.unique_key for record in written_records],
+            stamped_ids={record.pk for record in written_records}
+        )
+
+    return len(records_to_create), len(records_to_update)
@@ -0,0 +1,60 @@
+"""
+Compare write throughput of per-record POSTs against the bulk endpoint.
+All writes are rolled back, so it is safe to run against a dev database.
+"""
+import json
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+from dashboard.views import EmissionRecordViewSet
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-record POST /api/emissions/ against POST /api/emissions/bulk/"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=1000, help="Number of records per run")
+
+    def handle(self, *args, **options):
+        records = [
+            {
+                'company': f"Benchmark Company {i}",
+                'year': 2000 + i % 25,
+                'sector': f"Sector {i % 10}",
+                'energy_consumption_mwh': f"{1000 + i}.50",
+                'co2_emissions_tons': f"{500 + i}.25",
+            }
+            for i in range(options['records'])
+        ]
+        factory = APIRequestFactory()
+        create_view = EmissionRecordViewSet.as_view({'post': 'create'})
+        bulk_view = EmissionRecordViewSet.as_view({'post': 'bulk'})
+
+        def per_record():
+            for record in records:
+                create_view(factory.post('/api/emissions/', record, format='json'))
+
+        def bulk_json():
+            bulk_view(factory.post('/api/emissions/bulk/', records, format='json'))
+
+        def bulk_ndjson():
+            body = "\n".join(json.dumps(record) for record in records)
+            bulk_view(factory.post('/api/emissions/bulk/', body, content_type='application/x-ndjson'))
+
+        for label, run in (("per-record POST", per_record), ("bulk JSON", bulk_json), ("bulk NDJSON", bulk_ndjson)):
+            elapsed = self._timed_rollback(run)
+            self.stdout.write(
+                f"{label:<16} {len(records)} records in {elapsed:.3f}s "
+                f"({len(records) / elapsed:,.0f} records/s)"
+            )
+
+    @staticmethod
+    def _timed_rollback(run):
+        """Run inside a transaction that is always rolled back, return the elapsed seconds"""
+        with transaction.atomic():
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            transaction.set_rollback(True)
+        return elapsed
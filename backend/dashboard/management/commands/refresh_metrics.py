@@ -0,0 +1,28 @@
+"""
+Recompute the derived metrics of every record, e.g. after records were
+changed outside the import pipeline and the REST endpoints. With --missing
+only records without metrics (e.g. written before the metrics stage existed)
+are computed, which the migrate job runs after every migrate.
+"""
+from django.core.management.base import BaseCommand
+from dashboard.metrics import refresh_metrics
+from dashboard.models import EmissionRecord
+
+
+class Command(BaseCommand):
+    help = "Recompute the derived metrics (intensity, YoY change, percentiles, outliers) of all records"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--missing',
+            action='store_true',
+            help="Only compute the metrics of records that have none yet"
+        )
+
+    def handle(self, *args, **options):
+        records = EmissionRecord.objects.all()
+        if options['missing']:
+            records = records.filter(metrics__isnull=True)
+        keys = list(records.values_list('company', 'year', 'sector'))
+        refresh_metrics(keys)
+        self.stdout.write(f"Refreshed metrics of {len(keys)} records")
@@ -0,0 +1,196 @@
+"""
+Derived metrics stage of the import pipeline.
+
+After records are written, only the metrics touched by the write are
+recomputed: the (sector, year) groups the affected records belong to, and the
+YoY change of the next year of each affected (company, sector) series.
+Everything is computed in one pass over the records of those groups and their
+neighbouring years, loaded with a single query, and written back with bulk
+operations.
+"""
+import statistics
+from bisect import bisect_left
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import BULK_BATCH_SIZE, ChangeSequence, EmissionMetrics, EmissionRecord, SectorYearMetrics
+
+# |z-score| of the emission intensity within its sector and year from which a record is an outlier
+OUTLIER_ZSCORE_THRESHOLD = 2.5
+
+# Fields of EmissionMetrics written by refresh_metrics
+METRIC_FIELDS = [
+    'emission_intensity',
+    'intensity_percentile',
+    'intensity_zscore',
+    'is_outlier',
+    'emissions_yoy_change',
+    'emissions_yoy_change_pct',
+]
+
+
+def intensity(emissions, energy):
+    """tonnes CO2 per MWh, None when no energy was consumed"""
+    return emissions / energy if energy else None
+
+
+def change(current, previous):
+    """Absolute and percentage change, None when there is no previous value"""
+    if previous is None:
+        return None, None
+    return current - previous, (current - previous) / previous * 100 if previous else None
+
+
+def group_statistics(values):
+    """
+    Percentile rank, z-score and outlier flag for every value of a group,
+    returned as a dict keyed by value.
+    """
+    ordered = sorted(values)
+    count = len(ordered)
+    mean = statistics.fmean(ordered)
+    stdev = statistics.pstdev(ordered, mu=mean)
+    stats = {}
+    for value in ordered:
+        # Same definition as SQL PERCENT_RANK(): share of the other values below this one
+        percentile = bisect_left(ordered, value) / (count - 1) if count > 1 else 0.0
+        zscore = (value - mean) / stdev if stdev else 0.0
+        stats[value] = (percentile, zscore, abs(zscore) >= OUTLIER_ZSCORE_THRESHOLD)
+    return stats
+
+
+def refresh_metrics(keys, stamped_ids=()):
+    """
+    Recompute the metrics affected by writes to the given (company, year, sector) keys.
+    Records whose metrics changed get a new change feed sequence, except the ones in
+    stamped_ids which were already stamped by the write itself.
+    """
+    keys = set(keys)
+    if not keys:
+        return
+
+    affected_groups = {(sector, year) for _, year, sector in keys}
+    # The next year's YoY change depends on the affected year
+    next_years = {(company, year + 1, sector) for company, year, sector in keys}
+    affected_sector_years = affected_groups | {(sector, year + 1) for sector, year in affected_groups}
+
+    # The affected groups, the next years and the previous years their YoY change compares with
+    years_by_sector = defaultdict(set)
+    for sector, year in affected_groups:
+        years_by_sector[sector].update((year - 1, year, year + 1))
+    loaded = Q()
+    for sector, years in years_by_sector.items():
+        loaded |= Q(sector=sector, year__in=years)
+
+    with transaction.atomic():
+        # Every record those metrics depend on, a single query
+        records = list(
+            EmissionRecord.objects
+            .filter(loaded)
+            .select_related('metrics')
+            .order_by()
+        )
+
+        series = defaultdict(dict)   # (company, sector) -> {year: emissions}
+        groups = defaultdict(list)   # (sector, year) -> [intensity]
+        sector_totals = defaultdict(lambda: [0.0, 0.0])  # (sector, year) -> [emissions, energy]
+        intensities = {}
+        for record in records:
+            emissions = float(record.co2_emissions_tons)
+            energy = float(record.energy_consumption_mwh)
+            intensities[record.pk] = intensity(emissions, energy)
+            series[(record.company, record.sector)][record.year] = emissions
+            if intensities[record.pk] is not None:
+                groups[(record.sector, record.year)].append(intensities[record.pk])
+            totals = sector_totals[(record.sector, record.year)]
+            totals[0] += emissions
+            totals[1] += energy
+
+        group_stats = {}
+        metrics_to_create = []
+        metrics_to_update = []
+        changed_ids = []
+        for record in records:
+            group = (record.sector, record.year)
+            if group not in affected_groups and record.unique_key not in next_years:
+                continue
+
+            if group not in group_stats:
+                group_stats[group] = group_statistics(groups[group]) if groups[group] else {}
+            record_intensity = intensities[record.pk]
+            percentile, zscore, is_outlier = group_stats[group].get(record_intensity, (None, None, False))
+            company_series = series[(record.company, record.sector)]
+            yoy_change, yoy_change_pct = change(company_series[record.year], company_series.get(record.year - 1))
+            values = {
+                'emission_intensity': record_intensity,
+                'intensity_percentile': percentile,
+                'intensity_zscore': zscore,
+                'is_outlier': is_outlier,
+                'emissions_yoy_change': yoy_change,
+                'emissions_yoy_change_pct': yoy_change_pct,
+            }
+
+            try:
+                metrics = record.metrics
+            except EmissionMetrics.DoesNotExist:
+                metrics_to_create.append(EmissionMetrics(record=record, **values))
+                changed_ids.append(record.pk)
+                continue
+            if any(getattr(metrics, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(metrics, field, value)
+                metrics_to_update.append(metrics)
+                changed_ids.append(record.pk)
+
+        if metrics_to_create:
+            EmissionMetrics.objects.bulk_create(metrics_to_create, batch_size=BULK_BATCH_SIZE)
+        if metrics_to_update:
+            EmissionMetrics.objects.bulk_update(metrics_to_update, METRIC_FIELDS, batch_size=BULK_BATCH_SIZE)
+
+        _stamp_changed_records(set(changed_ids) - set(stamped_ids))
+        _refresh_sector_years(affected_sector_years, sector_totals)
+
+
+def _stamp_changed_records(record_ids):
+    """Give records whose metrics changed a new change feed sequence so clients refetch them"""
+    if not record_ids:
+        return
+    last_sequence = ChangeSequence.reserve(len(record_ids))
+    now = timezone.now()
+    records = [
+        EmissionRecord(pk=record_id, sequence=sequence, updated_at=now)
+        for sequence, record_id in enumerate(sorted(record_ids), start=last_sequence - len(record_ids) + 1)
+    ]
+    EmissionRecord.objects.bulk_update(records, ['sequence', 'updated_at'], batch_size=BULK_BATCH_SIZE)
+
+
+def _refresh_sector_years(sector_years, sector_totals):
+    """Replace the SectorYearMetrics rows of the given (sector, year) keys"""
+    rows = []
+    for sector, year in sector_years:
+        if (sector, year) not in sector_totals:
+            continue
+        emissions, energy = sector_totals[(sector, year)]
+        previous = sector_totals.get((sector, year - 1))
+        yoy_change, yoy_change_pct = change(emissions, previous[0] if previous else None)
+        rows.append(SectorYearMetrics(
+            sector=sector,
+            year=year,
+            total_emissions=emissions,
+            total_energy=energy,
+            emission_intensity=intensity(emissions, energy),
+            emissions_yoy_change=yoy_change,
+            emissions_yoy_change_pct=yoy_change_pct
+        ))
+
+    sectors = {sector for sector, _ in sector_years}
+    years = {year for _, year in sector_years}
+    stale_pks = [
+        pk for pk, sector, year
+        in SectorYearMetrics.objects.filter(sector__in=sectors, year__in=years).values_list('pk', 'sector', 'year')
+        if (sector, year) in sector_years
+    ]
+    if stale_pks:
+        SectorYearMetrics.objects.filter(pk__in=stale_pks).delete()
+    SectorYearMetrics.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE)
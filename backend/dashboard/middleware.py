@@ -0,0 +1,114 @@
+import re
+import time
+from pathlib import Path
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from .routers import routing_context, wrote_to_primary
+
+# Cookie that keeps a client's reads on the primary right after it wrote
+PRIMARY_STICKY_COOKIE = 'db_primary_sticky'
+
+# Methods of requests that do not write, the others read from the primary
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Request header asking for the request to be profiled (when PROFILING is on)
+PROFILE_HEADER = 'X-Profile'
+# Response header holding the name of the dumped profile
+PROFILE_FILE_HEADER = 'X-Profile-File'
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Give every request its own routing context. Requests that may write
+    (unsafe methods) read from the primary, so validation such as uniqueness
+    checks sees the data the write will hit. Requests that wrote (e.g. an
+    import) set a short lived cookie so that the client's next requests keep
+    reading from the primary until the replicas caught up.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sticky = PRIMARY_STICKY_COOKIE in request.COOKIES
+        with routing_context(pinned=sticky or request.method not in SAFE_METHODS):
+            response = self.get_response(request)
+            wrote = wrote_to_primary()
+
+        if wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                PRIMARY_STICKY_COOKIE,
+                '1',
+                max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True,
+                samesite='Lax'
+            )
+        return response
+
+
+
+class ProfilingMiddleware:
+    """
+    Opt-in profiling of slow requests for offline analysis.
+
+    Disabled unless settings.PROFILING is on. Then requests sent with the
+    X-Profile header (or every request with PROFILING_ALL_REQUESTS) are
+    profiled with cProfile, or pyinstrument when PROFILER = 'pyinstrument',
+    and the profile is written to PROFILING_DIR when the request took at
+    least PROFILING_SLOW_MS. Open .prof files with pstats or snakeviz.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.directory = Path(settings.PROFILING_DIR)
+
+    def __call__(self, request):
+        if not (settings.PROFILING_ALL_REQUESTS or PROFILE_HEADER in request.headers):
+            return self.get_response(request)
+
+        profiler = self._start_profiler()
+        if profiler is None:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            if settings.PROFILER == 'pyinstrument':
+                profiler.stop()
+            else:
+                profiler.disable()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        if elapsed_ms >= settings.PROFILING_SLOW_MS:
+            response[PROFILE_FILE_HEADER] = self._dump(profiler, request, elapsed_ms)
+        return response
+
+    def _start_profiler(self):
+        """Start a profiler, None if one is already running (e.g. in another thread)"""
+        try:
+            if settings.PROFILER == 'pyinstrument':
+                from pyinstrument import Profiler
+                profiler = Profiler()
+                profiler.start()
+            else:
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+        except (RuntimeError, ValueError):
+            return None
+        return profiler
+
+    def _dump(self, profiler, request, elapsed_ms):
+        """Write the profile to PROFILING_DIR and return its file name"""
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-') or 'root'
+        extension = 'html' if settings.PROFILER == 'pyinstrument' else 'prof'
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{request.method}-{slug}-{elapsed_ms:.0f}ms.{extension}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if settings.PROFILER == 'pyinstrument':
+            (self.directory / name).write_text(profiler.output_html())
+        else:
+            profiler.dump_stats(self.directory / name)
+        return name
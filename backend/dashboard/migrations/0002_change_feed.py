@@ -0,0 +1,64 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def seed_change_sequence(apps, schema_editor):
+    """
+    Give existing records unique sequences 1..N and start the counter at N,
+    so the change feed can page through them
+    """
+    ChangeSequence = apps.get_model('dashboard', 'ChangeSequence')
+    EmissionRecord = apps.get_model('dashboard', 'EmissionRecord')
+    records = list(EmissionRecord.objects.order_by('pk').only('pk'))
+    for sequence, record in enumerate(records, start=1):
+        record.sequence = sequence
+    EmissionRecord.objects.bulk_update(records, ['sequence'], batch_size=1000)
+    ChangeSequence.objects.update_or_create(pk=1, defaults={'value': len(records)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='emissionrecord',
+            unique_together={('company', 'year', 'sector')},
+        ),
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EmissionRecordTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('record_id', models.BigIntegerField()),
+                ('company', models.CharField(max_length=255)),
+                ('year', models.IntegerField()),
+                ('sector', models.CharField(max_length=255)),
+                ('sequence', models.BigIntegerField(db_index=True)),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['sequence'],
+            },
+        ),
+        migrations.AddField(
+            model_name='emissionrecord',
+            name='sequence',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='emissionrecord',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(seed_change_sequence, migrations.RunPython.noop),
+    ]
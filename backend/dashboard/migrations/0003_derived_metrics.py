@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0002_change_feed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmissionMetrics',
+            fields=[
+                ('record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='metrics', serialize=False, to='dashboard.emissionrecord')),
+                ('emission_intensity', models.FloatField(db_index=True, null=True)),
+                ('intensity_percentile', models.FloatField(db_index=True, null=True)),
+                ('intensity_zscore', models.FloatField(null=True)),
+                ('is_outlier', models.BooleanField(db_index=True, default=False)),
+                ('emissions_yoy_change', models.FloatField(null=True)),
+                ('emissions_yoy_change_pct', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SectorYearMetrics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sector', models.CharField(max_length=255)),
+                ('year', models.IntegerField()),
+                ('total_emissions', models.FloatField()),
+                ('total_energy', models.FloatField()),
+                ('emission_intensity', models.FloatField(null=True)),
+                ('emissions_yoy_change', models.FloatField(null=True)),
+                ('emissions_yoy_change_pct', models.FloatField(null=True)),
+            ],
+            options={
+                'ordering': ['sector', 'year'],
+                'unique_together': {('sector', 'year')},
+            },
+        ),
+    ]
@@ -1,4 +1,46 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+
+# Rows per INSERT/UPDATE statement of bulk writes, keeps large batches under parameter limits
+BULK_BATCH_SIZE = 1000
+
+
+class ChangeSequence(models.Model):
+    """
+    Single row counter that hands out change sequence numbers.
+    Reserving numbers locks the row until the surrounding transaction commits,
+    so sequence numbers become visible in the same order they were handed out.
+    """
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def reserve(cls, count=1):
+        """Reserve count sequence numbers and return the last one"""
+        with transaction.atomic():
+            if not cls.objects.filter(pk=1).update(value=F('value') + count):
+                cls.objects.create(pk=1, value=count)
+            return cls.objects.values_list('value', flat=True).get(pk=1)
+
+    @classmethod
+    def current(cls):
+        """Latest sequence number handed out, 0 if nothing was written yet"""
+        return cls.objects.filter(pk=1).values_list('value', flat=True).first() or 0
+
+
+class EmissionRecordQuerySet(models.QuerySet):
+    def delete(self):
+        """Delete the records leaving a tombstone for each one in the change feed"""
+        with transaction.atomic():
+            records = list(self.values('id', 'company', 'year', 'sector'))
+            if records:
+                last_sequence = ChangeSequence.reserve(len(records))
+                first_sequence = last_sequence - len(records) + 1
+                EmissionRecordTombstone.objects.bulk_create([
+                    EmissionRecordTombstone(record_id=record.pop('id'), sequence=sequence, **record)
+                    for sequence, record in enumerate(records, start=first_sequence)
+                ])
+            return super().delete()
+
 
 class EmissionRecord(models.Model):
     company = models.CharField(max_length=255)
@@ -15,6 +57,12 @@ class EmissionRecord(models.Model):
         decimal_places=2
     )
 
+    # Change feed bookkeeping, bumped on every write (see ChangeSequence)
+    sequence = models.BigIntegerField(default=0, db_index=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = EmissionRecordQuerySet.as_manager()
+
     class Meta:
         ordering = ["-year", "company"]
         verbose_name = "Emission Record"
@@ -22,4 +70,74 @@ class EmissionRecord(models.Model):
         unique_together = ("company", "year", "sector")
 
     def __str__(self):
-        return f"{self.company} – {self.year}"
\ No newline at end of file
+        return f"{self.company} – {self.year}"
+
+    @property
+    def unique_key(self):
+        return (self.company, self.year, self.sector)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'sequence', 'updated_at'}
+        with transaction.atomic():
+            self.sequence = ChangeSequence.reserve()
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            EmissionRecordTombstone.objects.create(
+                record_id=self.pk,
+                company=self.company,
+                year=self.year,
+                sector=self.sector,
+                sequence=ChangeSequence.reserve()
+            )
+            return super().delete(*args, **kwargs)
+
+
+class EmissionRecordTombstone(models.Model):
+    """Marker left behind by a deleted EmissionRecord so clients can sync deletes"""
+    record_id = models.BigIntegerField()
+    company = models.CharField(max_length=255)
+    year = models.IntegerField()
+    sector = models.CharField(max_length=255)
+    sequence = models.BigIntegerField(db_index=True)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["sequence"]
+
+
+class EmissionMetrics(models.Model):
+    """Derived metrics of an EmissionRecord, maintained by dashboard.metrics after every write"""
+    record = models.OneToOneField(
+        EmissionRecord,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='metrics'
+    )
+    # tonnes CO2 per MWh, null when no energy was consumed
+    emission_intensity = models.FloatField(null=True, db_index=True)
+    # Rank of the intensity within the record's sector and year, 0 (lowest) to 1 (highest)
+    intensity_percentile = models.FloatField(null=True, db_index=True)
+    intensity_zscore = models.FloatField(null=True)
+    is_outlier = models.BooleanField(default=False, db_index=True)
+    # Change against the same company and sector in the previous year, null without previous year
+    emissions_yoy_change = models.FloatField(null=True)
+    emissions_yoy_change_pct = models.FloatField(null=True)
+
+
+class SectorYearMetrics(models.Model):
+    """Totals of a sector in a year and their change against the previous year"""
+    sector = models.CharField(max_length=255)
+    year = models.IntegerField()
+    total_emissions = models.FloatField()
+    total_energy = models.FloatField()
+    emission_intensity = models.FloatField(null=True)
+    emissions_yoy_change = models.FloatField(null=True)
+    emissions_yoy_change_pct = models.FloatField(null=True)
+
+    class Meta:
+        ordering = ["sector", "year"]
+        unique_together = ("sector", "year")
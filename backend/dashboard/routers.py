@@ -0,0 +1,92 @@
+"""
+Database routing between the primary and the read replicas.
+
+Reads of dashboard models go to a replica (one per request, so every query of
+a request sees the same snapshot) and writes always go to the primary. Reads
+are pinned to the primary inside transactions, after a write in the same
+request and for a short while after a client wrote (see ReplicaStickinessMiddleware),
+so clients read their own writes despite replication lag.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Set when reads of the current request/context must use the primary
+_pinned_to_primary = ContextVar('pinned_to_primary', default=False)
+# Replica alias chosen for the current request/context
+_replica_alias = ContextVar('replica_alias', default=None)
+# Set once the current request/context wrote to the primary
+_wrote_to_primary = ContextVar('wrote_to_primary', default=False)
+
+
+def pin_to_primary():
+    """Send the remaining reads of the current context to the primary"""
+    _pinned_to_primary.set(True)
+
+
+def wrote_to_primary():
+    return _wrote_to_primary.get()
+
+
+@contextmanager
+def use_primary():
+    """Read from the primary inside the with block"""
+    token = _pinned_to_primary.set(True)
+    try:
+        yield
+    finally:
+        _pinned_to_primary.reset(token)
+
+
+@contextmanager
+def routing_context(pinned=False):
+    """
+    Scope the routing state to a unit of work (e.g. a request): pick a single
+    replica for it and optionally start pinned to the primary.
+    """
+    replicas = settings.DATABASE_REPLICAS
+    pinned_token = _pinned_to_primary.set(pinned)
+    wrote_token = _wrote_to_primary.set(False)
+    replica_token = _replica_alias.set(random.choice(replicas) if replicas else None)
+    try:
+        yield
+    finally:
+        _replica_alias.reset(replica_token)
+        _wrote_to_primary.reset(wrote_token)
+        _pinned_to_primary.reset(pinned_token)
+
+
+class PrimaryReplicaRouter:
+    """Route dashboard reads to the replicas in settings.DATABASE_REPLICAS"""
+    route_app_labels = {'dashboard'}
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in self.route_app_labels:
+            return None
+        replicas = settings.DATABASE_REPLICAS
+        if (
+            not replicas
+            or _pinned_to_primary.get()
+            # Reads that decide what to write must see the primary's state
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return _replica_alias.get() or random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in self.route_app_labels:
+            return None
+        # Read your writes for the rest of the context
+        _pinned_to_primary.set(True)
+        _wrote_to_primary.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are migrated through replication
+        return db not in settings.DATABASE_REPLICAS
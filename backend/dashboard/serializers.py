@@ -1,7 +1,19 @@
 from rest_framework import serializers
-from .models import EmissionRecord
+from .models import EmissionMetrics, EmissionRecord, SectorYearMetrics
+
+class EmissionMetricsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EmissionMetrics
+        exclude = ("record",)
 
 class EmissionRecordSerializer(serializers.ModelSerializer):
+    metrics = EmissionMetricsSerializer(read_only=True)
+
     class Meta:
         model = EmissionRecord
         fields = "__all__"
+
+class SectorYearMetricsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SectorYearMetrics
+        exclude = ("id",)
\ No newline at end of file
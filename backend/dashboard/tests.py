@@ -1,9 +1,41 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import math
+import tempfile
+from contextlib import contextmanager
+from importlib import import_module
+from pathlib import Path
+from unittest import mock
+from django.apps import apps
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import connection, connections, models
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.core.files.uploadedfile import SimpleUploadedFile
-from .models import EmissionRecord
+from .models import BULK_BATCH_SIZE, ChangeSequence, EmissionMetrics, EmissionRecord, SectorYearMetrics
 from .csv_config import CSV_HEADERS
+from .importer import ERROR_SAMPLE_SIZE
+from .metrics import METRIC_FIELDS, refresh_metrics
+from .middleware import (
+    PRIMARY_STICKY_COOKIE, PROFILE_FILE_HEADER, ProfilingMiddleware, ReplicaStickinessMiddleware
+)
+from .routers import PrimaryReplicaRouter, routing_context, use_primary
+
+
+def make_record(company='Company A', year=2023, sector='Energy', energy=1000.50, emissions=500.25):
+    """Build a record for the bulk and REST endpoints using the model field names"""
+    return {
+        'company': company,
+        'year': year,
+        'sector': sector,
+        'energy_consumption_mwh': energy,
+        'co2_emissions_tons': emissions,
+    }
 
 
 class CSVUploadTestCase(TestCase):
@@ -255,3 +287,792 @@ Company C,2023,Services,2000.50,500.25"""
         self.assertEqual(response.data['created'], 1)
         self.assertEqual(len(response.data['errors']), 2)
         self.assertEqual(EmissionRecord.objects.count(), 1)
+
+    def test_values_out_of_model_limits(self):
+        """Test that values the database can not store are rejected per row"""
+        csv_content = f"""{self.csv_header_line}
+Company A,2023,Energy,nan,500.25
+{'X' * 256},2023,Energy,1000.50,500.25
+Company C,2023,Energy,1000.50,99999999999
+Company D,99999999999999999999,Energy,1000.50,500.25
+Company E,2023,Energy,1000.50,500.25"""
+        
+        file = self.create_csv_file(csv_content)
+        response = self.client.post(self.upload_url, {'file': file})
+        
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['error_counts'], {'invalid_format': 4})
+
+
+class BulkWriteTestCase(TestCase):
+    """Test cases for the JSON/NDJSON bulk write endpoint"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.bulk_url = '/api/emissions/bulk/'
+
+    def post_ndjson(self, lines):
+        """Helper method to post records as newline-delimited JSON"""
+        body = "\n".join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+        return self.client.post(self.bulk_url, body, content_type='application/x-ndjson')
+
+    def test_bulk_json_creates_records(self):
+        """Test that a JSON list of records creates new records"""
+        records = [
+            make_record(),
+            make_record(company='Company B', sector='Manufacturing', energy='2000,75', emissions='1000.50'),
+        ]
+        response = self.client.post(self.bulk_url, records, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['updated'], 0)
+        self.assertEqual(EmissionRecord.objects.count(), 2)
+        record = EmissionRecord.objects.get(company='Company B')
+        self.assertEqual(float(record.energy_consumption_mwh), 2000.75)
+
+    def test_bulk_json_accepts_records_envelope(self):
+        """Test that records wrapped in a {"records": [...]} object are accepted"""
+        response = self.client.post(self.bulk_url, {'records': [make_record()]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(EmissionRecord.objects.count(), 1)
+
+    def test_bulk_ndjson_updates_and_deduplicates(self):
+        """Test that NDJSON batches share the CSV upsert and duplicate semantics"""
+        EmissionRecord.objects.create(
+            company='Company A',
+            year=2023,
+            sector='Energy',
+            energy_consumption_mwh=1000,
+            co2_emissions_tons=500
+        )
+        response = self.post_ndjson([
+            make_record(energy=2500, emissions=750),
+            make_record(energy=100, emissions=50),
+            '',
+            make_record(company='Company B'),
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['updated'], 1)
+        self.assertEqual(len(response.data['errors']), 1)
+        self.assertIn('Record 2: Duplicate entry', response.data['errors'][0])
+        record = EmissionRecord.objects.get(company='Company A')
+        self.assertEqual(float(record.energy_consumption_mwh), 2500.00)
+
+    def test_bulk_reports_invalid_records(self):
+        """Test that invalid records are skipped and reported by record number"""
+        response = self.post_ndjson([
+            make_record(year='2023abc'),
+            '{not json',
+            make_record(company=''),
+            '[1, 2]',
+            make_record(company=['x']),
+            make_record(sector={'a': 1}),
+            make_record(company=True),
+            make_record(company='Company B'),
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(len(response.data['errors']), 7)
+        self.assertIn('Record 1: Invalid data format', response.data['errors'][0])
+        self.assertIn('Record 2: Invalid JSON', response.data['errors'][1])
+        self.assertIn('Record 3: Missing required fields', response.data['errors'][2])
+        self.assertIn('Record 4: Expected an object', response.data['errors'][3])
+        self.assertIn('Record 5: Invalid data format - company must be a string', response.data['errors'][4])
+        self.assertIn('Record 6: Invalid data format - sector must be a string', response.data['errors'][5])
+        self.assertIn('Record 7: Invalid data format - company must be a string', response.data['errors'][6])
+        self.assertEqual(list(EmissionRecord.objects.values_list('company', flat=True)), ['Company B'])
+
+    def test_bulk_rejects_non_finite_numbers(self):
+        """Test that NaN and Infinity are rejected per record instead of failing the batch"""
+        response = self.post_ndjson([
+            '{"company": "Company A", "year": 2023, "sector": "Energy", '
+            '"energy_consumption_mwh": NaN, "co2_emissions_tons": 1}',
+            # Overflows to inf when parsed
+            '{"company": "Company B", "year": 2023, "sector": "Energy", '
+            '"energy_consumption_mwh": 1, "co2_emissions_tons": 1e400}',
+            make_record(company='Company C'),
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 1)
+        self.assertIn('Record 1: Invalid JSON', response.data['errors'][0])
+        self.assertIn('Record 2: Invalid data format', response.data['errors'][1])
+
+    def test_bulk_rejects_non_list_body(self):
+        """Test that a JSON body that is not a list of records is rejected"""
+        response = self.client.post(self.bulk_url, {'company': 'Company A'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Expected a list', response.data['error'])
+
+    def test_bulk_without_valid_records(self):
+        """Test that a batch without any valid record is rejected"""
+        response = self.client.post(self.bulk_url, [make_record(year=None)], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('No valid records', response.data['error'])
+        self.assertEqual(EmissionRecord.objects.count(), 0)
+
+
+class DryRunImportTestCase(TestCase):
+    """Test cases for the validation-only import mode and the error report"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.upload_url = '/api/emissions/import_csv/'
+        self.csv_header_line = ','.join(CSV_HEADERS.values())
+
+    def upload(self, lines, **params):
+        content = '\n'.join([self.csv_header_line] + lines).encode('utf-8')
+        file = SimpleUploadedFile('emissions.csv', content, content_type='text/csv')
+        query = '&'.join(f'{key}={value}' for key, value in params.items())
+        return self.client.post(f'{self.upload_url}?{query}', {'file': file})
+
+    def bad_rows(self, count):
+        return [f"Company {i},20x3,Energy,1000,500" for i in range(count)]
+
+    def test_dry_run_does_not_touch_the_database(self):
+        """Test that a dry run validates the file without any query"""
+        with self.assertNumQueries(0):
+            response = self.upload(["Company A,2023,Energy,1000.50,500.25"], dry_run=1)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['dry_run'])
+        self.assertTrue(response.data['valid'])
+        self.assertEqual(response.data['rows_checked'], 1)
+        self.assertEqual(response.data['valid_rows'], 1)
+        self.assertEqual(EmissionRecord.objects.count(), 0)
+
+    def test_dry_run_reports_structured_errors(self):
+        """Test that errors carry the row, the CSV column and an error code"""
+        response = self.upload([
+            "Company A,2023,Energy,1000.50,500.25",
+            "Company B,abc,Energy,1000.50,500.25",
+            "Company C,2023,,1000.50,500.25",
+            "Company A,2023,Energy,10,5",
+        ], dry_run='true')
+
+        self.assertFalse(response.data['valid'])
+        self.assertEqual(response.data['valid_rows'], 1)
+        self.assertEqual(response.data['error_count'], 3)
+        self.assertEqual(response.data['error_counts'], {'invalid_format': 1, 'missing_field': 1, 'duplicate': 1})
+        invalid, missing, duplicate = response.data['errors']
+        self.assertEqual(invalid['row'], 3)
+        self.assertEqual(invalid['column'], CSV_HEADERS['YEAR'])
+        self.assertEqual(invalid['code'], 'invalid_format')
+        self.assertEqual((missing['row'], missing['column']), (4, CSV_HEADERS['SECTOR']))
+        self.assertEqual((duplicate['row'], duplicate['column'], duplicate['code']), (5, None, 'duplicate'))
+
+    def test_dry_run_with_only_duplicates_is_valid(self):
+        """Test that duplicates, which an import resolves, are warnings that keep the file valid"""
+        response = self.upload([
+            "Company A,2023,Energy,1000.50,500.25",
+            "Company A,2023,Energy,10,5",
+        ], dry_run=1)
+
+        self.assertTrue(response.data['valid'])
+        self.assertEqual(response.data['error_count'], 1)
+        self.assertEqual(response.data['warning_count'], 1)
+        self.assertEqual(response.data['errors'][0]['code'], 'duplicate')
+
+    def test_dry_run_caps_error_samples(self):
+        """Test that every error is counted but only a sample is returned"""
+        response = self.upload(self.bad_rows(ERROR_SAMPLE_SIZE + 50), dry_run=1)
+
+        self.assertFalse(response.data['aborted'])
+        self.assertEqual(response.data['error_count'], ERROR_SAMPLE_SIZE + 50)
+        self.assertEqual(len(response.data['errors']), ERROR_SAMPLE_SIZE)
+
+    def test_dry_run_stops_at_max_errors(self):
+        """Test that validation stops reading the file once max_errors is reached"""
+        response = self.upload(self.bad_rows(10) + ["Company A,2023,Energy,1000.50,500.25"], dry_run=1, max_errors=3)
+
+        self.assertTrue(response.data['aborted'])
+        self.assertEqual(response.data['rows_checked'], 3)
+        self.assertEqual(response.data['error_count'], 3)
+
+    def test_import_over_max_errors_writes_nothing(self):
+        """Test that an import hitting max_errors is rejected as a whole"""
+        response = self.upload(["Company A,2023,Energy,1000.50,500.25"] + self.bad_rows(5), max_errors=2)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(response.data['aborted'])
+        self.assertEqual(EmissionRecord.objects.count(), 0)
+
+    def test_import_reports_error_counts(self):
+        """Test that a regular import also counts its errors per code"""
+        response = self.upload(["Company A,2023,Energy,1000.50,500.25"] + self.bad_rows(2))
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['error_count'], 2)
+        self.assertEqual(response.data['error_counts'], {'invalid_format': 2})
+
+    def test_error_report_streams_every_error(self):
+        """Test that the downloadable report is streamed and not capped"""
+        response = self.upload(self.bad_rows(ERROR_SAMPLE_SIZE + 50), dry_run=1, report='csv')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('emissions-errors.csv', response['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ['row', 'column', 'code', 'message'])
+        self.assertEqual(len(rows), ERROR_SAMPLE_SIZE + 51)
+        self.assertEqual(rows[1][:3], ['2', CSV_HEADERS['YEAR'], 'invalid_format'])
+
+    def test_error_report_ends_with_read_failures(self):
+        """Test that a file failing to decode halfway through ends the streamed report with an error row"""
+        # Past the first chunk the file is decoded in, which the headers are read from
+        content = '\n'.join([self.csv_header_line] + self.bad_rows(1000)).encode('utf-8')
+        file = SimpleUploadedFile('emissions.csv', content + b'\nCompany \xff,2023,Energy,1,1', content_type='text/csv')
+
+        response = self.client.post(f'{self.upload_url}?dry_run=1&report=csv', {'file': file})
+
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[1][:3], ['2', CSV_HEADERS['YEAR'], 'invalid_format'])
+        self.assertEqual(rows[-1][:3], ['', '', 'unexpected'])
+        self.assertIn('Failed to process CSV', rows[-1][3])
+
+    def test_invalid_parameters(self):
+        """Test that report=csv without dry_run and non-positive or non-integer max_errors are rejected"""
+        self.assertEqual(self.upload([], report='csv').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.upload([], dry_run=1, max_errors=0).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.upload([], dry_run=1, max_errors='x').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.upload([], dry_run=1, max_errors='²').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ChangeFeedTestCase(TestCase):
+    """Test cases for the incremental change feed"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.changes_url = '/api/emissions/changes/'
+        self.bulk_url = '/api/emissions/bulk/'
+
+    def get_changes(self, **params):
+        response = self.client.get(self.changes_url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_initial_sync_returns_all_records(self):
+        """Test that a sync without cursor returns every record and the current cursor"""
+        self.client.post(self.bulk_url, [make_record(), make_record('Company B')], format='json')
+
+        data = self.get_changes()
+
+        self.assertEqual(len(data['changed']), 2)
+        self.assertEqual(data['deleted'], [])
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['cursor'], max(record['sequence'] for record in data['changed']))
+
+    def test_since_returns_only_deltas(self):
+        """Test that imports, ViewSet writes and deletes all show up after the cursor"""
+        self.client.post(self.bulk_url, [make_record(), make_record('Company B')], format='json')
+        cursor = self.get_changes()['cursor']
+        self.assertEqual(self.get_changes(since=cursor)['changed'], [])
+
+        record_a = EmissionRecord.objects.get(company='Company A')
+        record_b = EmissionRecord.objects.get(company='Company B')
+        # Bulk update of an existing record
+        self.client.post(self.bulk_url, [make_record(energy=2000)], format='json')
+        # ViewSet create and delete
+        self.client.post('/api/emissions/', make_record('Company C'), format='json')
+        self.client.delete(f'/api/emissions/{record_b.id}/')
+
+        data = self.get_changes(since=cursor)
+
+        self.assertEqual(
+            [record['company'] for record in data['changed']],
+            ['Company A', 'Company C']
+        )
+        self.assertEqual(data['changed'][0]['id'], record_a.id)
+        self.assertEqual(len(data['deleted']), 1)
+        self.assertEqual(data['deleted'][0]['id'], record_b.id)
+        self.assertGreater(data['cursor'], cursor)
+        self.assertEqual(self.get_changes(since=data['cursor'])['changed'], [])
+
+    def test_queryset_delete_leaves_tombstones(self):
+        """Test that bulk deletes through the queryset are also in the feed"""
+        self.client.post(self.bulk_url, [make_record(), make_record('Company B')], format='json')
+        cursor = self.get_changes()['cursor']
+
+        EmissionRecord.objects.all().delete()
+
+        data = self.get_changes(since=cursor)
+        self.assertEqual(len(data['deleted']), 2)
+
+    def test_changes_pagination(self):
+        """Test that limit pages through the feed using the returned cursor"""
+        self.client.post(
+            self.bulk_url,
+            [make_record(f'Company {i}') for i in range(5)],
+            format='json'
+        )
+
+        first_page = self.get_changes(limit=3)
+        second_page = self.get_changes(since=first_page['cursor'], limit=3)
+
+        self.assertTrue(first_page['has_more'])
+        self.assertEqual(len(first_page['changed']), 3)
+        self.assertFalse(second_page['has_more'])
+        self.assertEqual(len(second_page['changed']), 2)
+
+    def test_invalid_cursor(self):
+        """Test that a non-integer cursor is rejected"""
+        response = self.client.get(self.changes_url, {'since': 'abc'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cursor_ahead_of_feed_resets(self):
+        """Test that a cursor from a reset database returns a full resync"""
+        self.client.post(self.bulk_url, [make_record()], format='json')
+
+        data = self.get_changes(since=1000)
+
+        self.assertTrue(data['reset'])
+        self.assertEqual(len(data['changed']), 1)
+
+    @override_settings(DATABASE_REPLICAS=['replica_1'])
+    def test_lagging_replica_does_not_reset_the_feed(self):
+        """Test that a cursor ahead of a lagging replica is checked on the primary instead of resetting"""
+        self.client.post(self.bulk_url, [make_record(), make_record('Company B')], format='json')
+        cursor = ChangeSequence.current()
+        primary_current = ChangeSequence.current
+        # The sticky cookie of the write expired
+        self.client.cookies.clear()
+
+        def current():
+            # The test database is the primary, the replica has not seen any write yet
+            with mock.patch.object(connections['default'], 'in_atomic_block', False):
+                alias = PrimaryReplicaRouter().db_for_read(ChangeSequence)
+            return primary_current() if alias == 'default' else 0
+
+        with mock.patch.object(ChangeSequence, 'current', side_effect=current):
+            data = self.get_changes(since=cursor)
+
+        self.assertFalse(data['reset'])
+        self.assertEqual(data['cursor'], cursor)
+        self.assertEqual(data['changed'], [])
+
+    def test_records_from_before_the_change_feed_can_be_paged(self):
+        """Test that the migration gives existing records unique sequences"""
+        self.client.post(self.bulk_url, [make_record(f'Company {i}') for i in range(5)], format='json')
+        # State of a database migrated from before the change feed existed
+        EmissionRecord.objects.update(sequence=0)
+        ChangeSequence.objects.update(value=0)
+
+        import_module('dashboard.migrations.0002_change_feed').seed_change_sequence(apps, None)
+
+        cursor, seen = 0, []
+        for _ in range(3):
+            data = self.get_changes(since=cursor, limit=3)
+            seen += [record['id'] for record in data['changed']]
+            cursor = data['cursor']
+            if not data['has_more']:
+                break
+        self.assertFalse(data['has_more'])
+        self.assertCountEqual(seen, EmissionRecord.objects.values_list('id', flat=True))
+        self.assertEqual(ChangeSequence.current(), 5)
+
+    def test_event_stream_ends_after_its_lifetime(self):
+        """Test that the event stream reports changes and ends instead of holding a thread forever"""
+        self.client.post(self.bulk_url, [make_record()], format='json')
+
+        with mock.patch('dashboard.views.time.sleep') as sleep, \
+                mock.patch('dashboard.views.CHANGES_STREAM_MAX_LIFETIME', 30):
+            response = self.client.get('/api/emissions/changes/stream/', {'since': 0})
+            body = b''.join(response.streaming_content).decode()
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertIn(f"id: {ChangeSequence.current()}\nevent: change", body)
+        self.assertIn(': keep-alive', body)
+        self.assertEqual(sleep.call_count, 30)
+
+    async def test_event_stream_is_live_over_asgi(self):
+        """Test that over ASGI the first event arrives while the stream is still open"""
+        await EmissionRecord.objects.acreate(**make_record())
+
+        response = await self.async_client.get('/api/emissions/changes/stream/', {'since': 0})
+        self.assertTrue(response.is_async)
+        events = aiter(response.streaming_content)
+        first_event = await asyncio.wait_for(anext(events), timeout=5)
+        await events.aclose()
+
+        self.assertIn(b'event: change', first_event)
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1', 'replica_2'], REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTestCase(SimpleTestCase):
+    """Test cases for the primary/replica database router"""
+
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+
+    def test_reads_go_to_one_replica_per_context(self):
+        """Test that every read of a context uses the same replica"""
+        with routing_context():
+            aliases = {self.router.db_for_read(EmissionRecord) for _ in range(20)}
+        self.assertEqual(len(aliases), 1)
+        self.assertIn(aliases.pop(), ['replica_1', 'replica_2'])
+
+    def test_writes_go_to_primary_and_pin_reads(self):
+        """Test that after a write the context reads its own writes from the primary"""
+        with routing_context():
+            self.assertEqual(self.router.db_for_write(EmissionRecord), 'default')
+            self.assertEqual(self.router.db_for_read(EmissionRecord), 'default')
+
+    def test_use_primary_and_transactions_read_from_primary(self):
+        """Test that use_primary() and open transactions read from the primary"""
+        with routing_context():
+            with use_primary():
+                self.assertEqual(self.router.db_for_read(EmissionRecord), 'default')
+            self.assertNotEqual(self.router.db_for_read(EmissionRecord), 'default')
+            with mock.patch.object(connections['default'], 'in_atomic_block', True):
+                self.assertEqual(self.router.db_for_read(EmissionRecord), 'default')
+
+    def test_other_apps_are_not_routed(self):
+        """Test that models outside the dashboard app keep the default routing"""
+        from django.contrib.auth.models import User
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_write(User))
+
+    def test_replicas_are_not_migrated(self):
+        """Test that migrations only run on the primary"""
+        self.assertTrue(self.router.allow_migrate('default', 'dashboard'))
+        self.assertFalse(self.router.allow_migrate('replica_1', 'dashboard'))
+
+    def test_middleware_makes_writers_sticky(self):
+        """Test that a request that wrote gets the sticky cookie and later reads use the primary"""
+        factory = RequestFactory()
+
+        def write_view(request):
+            self.router.db_for_write(EmissionRecord)
+            return HttpResponse()
+
+        def read_view(request):
+            return HttpResponse(self.router.db_for_read(EmissionRecord))
+
+        response = ReplicaStickinessMiddleware(write_view)(factory.post('/'))
+        self.assertEqual(response.cookies[PRIMARY_STICKY_COOKIE]['max-age'], 5)
+
+        response = ReplicaStickinessMiddleware(read_view)(factory.get('/'))
+        self.assertNotEqual(response.content, b'default')
+        self.assertNotIn(PRIMARY_STICKY_COOKIE, response.cookies)
+
+        request = factory.get('/')
+        request.COOKIES[PRIMARY_STICKY_COOKIE] = '1'
+        response = ReplicaStickinessMiddleware(read_view)(request)
+        self.assertEqual(response.content, b'default')
+
+    def test_middleware_validates_unsafe_requests_on_primary(self):
+        """Test that reads of a POST (e.g. uniqueness validation) use the primary before it writes"""
+        factory = RequestFactory()
+
+        def read_view(request):
+            return HttpResponse(self.router.db_for_read(EmissionRecord))
+
+        for method in ('post', 'put', 'patch', 'delete'):
+            response = ReplicaStickinessMiddleware(read_view)(getattr(factory, method)('/'))
+            self.assertEqual(response.content, b'default', method)
+            # Nothing was written, so the client does not become sticky
+            self.assertNotIn(PRIMARY_STICKY_COOKIE, response.cookies)
+
+
+class DerivedMetricsTestCase(TestCase):
+    """Test cases for the derived metrics computed after each write"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.bulk_url = '/api/emissions/bulk/'
+
+    def metrics_of(self, company, year, sector='Energy'):
+        return EmissionMetrics.objects.get(record__company=company, record__year=year, record__sector=sector)
+
+    def test_import_computes_record_metrics(self):
+        """Test intensity, YoY change and sector percentile after an import"""
+        self.client.post(self.bulk_url, [
+            make_record('Company A', 2022, 'Energy', 100, 50),
+            make_record('Company A', 2023, 'Energy', 100, 75),
+            make_record('Company B', 2023, 'Energy', 100, 25),
+            make_record('Company C', 2023, 'Energy', 0, 10),
+        ], format='json')
+
+        metrics = self.metrics_of('Company A', 2023)
+        self.assertAlmostEqual(metrics.emission_intensity, 0.75)
+        self.assertAlmostEqual(metrics.emissions_yoy_change, 25)
+        self.assertAlmostEqual(metrics.emissions_yoy_change_pct, 50)
+        self.assertEqual(metrics.intensity_percentile, 1.0)
+        self.assertEqual(self.metrics_of('Company B', 2023).intensity_percentile, 0.0)
+        self.assertIsNone(self.metrics_of('Company A', 2022).emissions_yoy_change)
+        # No energy consumed, no intensity
+        self.assertIsNone(self.metrics_of('Company C', 2023).emission_intensity)
+
+        response = self.client.get('/api/emissions/', {'search': 'Company A'})
+        self.assertAlmostEqual(response.data[0]['metrics']['emission_intensity'], 0.75)
+
+    def test_outlier_flag(self):
+        """Test that a record far from its sector's intensity is flagged"""
+        records = [make_record(f'Company {i}', 2023, 'Energy', 100, 50) for i in range(10)]
+        records.append(make_record('Company X', 2023, 'Energy', 100, 500))
+        self.client.post(self.bulk_url, records, format='json')
+
+        self.assertTrue(self.metrics_of('Company X', 2023).is_outlier)
+        self.assertFalse(self.metrics_of('Company 0', 2023).is_outlier)
+        response = self.client.get('/api/emissions/', {'outliers': 'true'})
+        self.assertEqual([record['company'] for record in response.data], ['Company X'])
+
+    def test_only_touched_keys_are_recomputed(self):
+        """Test that other sectors are untouched and neighbours of a changed record are refreshed"""
+        self.client.post(self.bulk_url, [
+            make_record('Company A', 2023, 'Energy', 100, 50),
+            make_record('Company B', 2023, 'Energy', 100, 25),
+            make_record('Company C', 2023, 'Retail', 100, 10),
+        ], format='json')
+        retail = self.metrics_of('Company C', 2023, 'Retail')
+        cursor = self.client.get('/api/emissions/changes/').data['cursor']
+
+        # Company B becomes the most intensive of the sector
+        self.client.post(self.bulk_url, [make_record('Company B', 2023, 'Energy', 100, 90)], format='json')
+
+        self.assertEqual(self.metrics_of('Company A', 2023).intensity_percentile, 0.0)
+        self.assertEqual(self.metrics_of('Company B', 2023).intensity_percentile, 1.0)
+        self.assertEqual(self.metrics_of('Company C', 2023, 'Retail').pk, retail.pk)
+        # Company A was not written but its metrics changed, so it is in the change feed
+        changed = self.client.get('/api/emissions/changes/', {'since': cursor}).data['changed']
+        self.assertEqual(sorted(record['company'] for record in changed), ['Company A', 'Company B'])
+
+    def test_single_write_matches_full_recompute(self):
+        """Test that refreshing only the touched groups gives the same metrics as recomputing everything"""
+        self.client.post(self.bulk_url, [
+            make_record(f'Company {i}', year, 'Energy', 100 + i, 10 * i + year % 7)
+            for i in range(5) for year in range(2019, 2024)
+        ], format='json')
+        record = EmissionRecord.objects.get(company='Company 2', year=2021)
+        self.client.patch(f'/api/emissions/{record.id}/', {'co2_emissions_tons': 400}, format='json')
+        incremental = {metrics.pk: metrics for metrics in EmissionMetrics.objects.all()}
+
+        refresh_metrics(EmissionRecord.objects.values_list('company', 'year', 'sector'))
+
+        for metrics in EmissionMetrics.objects.all():
+            for field in METRIC_FIELDS:
+                self.assertEqual(getattr(incremental[metrics.pk], field), getattr(metrics, field), field)
+
+    def test_refresh_metrics_command_backfills_missing_metrics(self):
+        """Test that refresh_metrics --missing computes the metrics of records written without them"""
+        # Plain ORM writes skip the metrics stage, like records from before it existed
+        EmissionRecord.objects.create(**make_record('Company A', 2023, 'Energy', 100, 50))
+
+        call_command('refresh_metrics', '--missing', stdout=io.StringIO())
+
+        self.assertAlmostEqual(self.metrics_of('Company A', 2023).emission_intensity, 0.5)
+
+    def test_update_returns_fresh_metrics(self):
+        """Test that a PATCH response carries the metrics recomputed by the write"""
+        self.client.post(self.bulk_url, [make_record('Company A', 2023, 'Energy', 100, 1)], format='json')
+        record = EmissionRecord.objects.get(company='Company A')
+
+        response = self.client.patch(f'/api/emissions/{record.id}/', {'co2_emissions_tons': 50}, format='json')
+
+        self.assertAlmostEqual(response.data['metrics']['emission_intensity'], 0.5)
+
+    def test_sector_metrics_and_delete(self):
+        """Test sector YoY totals and that deletes refresh them"""
+        self.client.post(self.bulk_url, [
+            make_record('Company A', 2022, 'Energy', 100, 50),
+            make_record('Company A', 2023, 'Energy', 100, 60),
+            make_record('Company B', 2023, 'Energy', 100, 40),
+        ], format='json')
+
+        response = self.client.get('/api/emissions/sector_metrics/', {'sector': 'Energy'})
+        self.assertEqual([row['year'] for row in response.data], [2022, 2023])
+        self.assertAlmostEqual(response.data[1]['total_emissions'], 100)
+        self.assertAlmostEqual(response.data[1]['emissions_yoy_change'], 50)
+
+        record_b = EmissionRecord.objects.get(company='Company B')
+        self.client.delete(f'/api/emissions/{record_b.id}/')
+
+        sector_2023 = SectorYearMetrics.objects.get(sector='Energy', year=2023)
+        self.assertAlmostEqual(sector_2023.total_emissions, 60)
+        self.assertAlmostEqual(sector_2023.emissions_yoy_change_pct, 20)
+
+
+
+class RowCounter:
+    """
+    Count the rows the SELECT queries run inside the with block can return.
+    Each SELECT is re-run as a COUNT(*) on a backend cursor, which is neither
+    logged nor wrapped, so assertNumQueries counts are not affected.
+    """
+
+    def __init__(self, db=connection):
+        self.db = db
+        self.rows = 0
+
+    def __enter__(self):
+        self._wrapper = self.db.execute_wrapper(self._count_rows)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._wrapper.__exit__(*exc_info)
+
+    def _count_rows(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if not many and sql.lstrip().upper().startswith('SELECT'):
+            cursor = self.db.create_cursor()
+            try:
+                cursor.execute(f"SELECT COUNT(*) FROM ({sql}) counted", params)
+                self.rows += cursor.fetchone()[0]
+            finally:
+                cursor.close()
+        return result
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Regression guards on the number of queries and rows fetched by the import
+    pipeline and the read endpoints, to catch N+1 queries and bulk operations
+    silently turning into per-row statements.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.csv_header_line = ','.join(CSV_HEADERS.values())
+
+    @contextmanager
+    def assertQueryBudget(self, num_queries, max_rows):
+        with self.assertNumQueries(num_queries), RowCounter() as counter:
+            yield
+        self.assertLessEqual(counter.rows, max_rows, f"{counter.rows} rows fetched, expected at most {max_rows}")
+
+    def batches(self, model, count):
+        """Number of INSERT statements bulk_create needs for count objects on this backend"""
+        fields = [field for field in model._meta.concrete_fields if not isinstance(field, models.AutoField)]
+        batch_size = min(BULK_BATCH_SIZE, connection.ops.bulk_batch_size(fields, [None] * count))
+        return math.ceil(count / batch_size)
+
+    def import_csv(self, rows):
+        lines = [self.csv_header_line] + [
+            f"Company {i},2023,Sector {i % 5},{1000 + i}.50,{500 + i}.25" for i in range(rows)
+        ]
+        file = SimpleUploadedFile('test.csv', '\n'.join(lines).encode('utf-8'), content_type='text/csv')
+        return self.client.post('/api/emissions/import_csv/', {'file': file})
+
+    def test_import_csv_query_count_does_not_grow_with_file_size(self):
+        """Test that importing new records costs a fixed number of queries plus insert batches"""
+        for rows in (1, 10, 100, 500):
+            EmissionRecord.objects.all().delete()
+            SectorYearMetrics.objects.all().delete()
+            # 2 savepoints x 2, existing records lookup, sequence reservation (4),
+            # records lookup for the metrics, sector metrics lookup and insert
+            expected = 12 + self.batches(EmissionRecord, rows) + self.batches(EmissionMetrics, rows)
+            with self.subTest(rows=rows), self.assertQueryBudget(expected, max_rows=rows + 1):
+                response = self.import_csv(rows)
+            self.assertEqual(response.data['created'], rows)
+
+    def test_unchanged_import_csv_only_looks_up_existing_records(self):
+        """Test that re-importing the same file does not write or recompute anything"""
+        self.import_csv(100)
+
+        with self.assertQueryBudget(3, max_rows=100):
+            response = self.import_csv(100)
+        self.assertEqual(response.data['updated'], 0)
+
+    def test_single_write_only_loads_neighbouring_years(self):
+        """Test that the metrics of one record are refreshed from its group and the adjacent years only"""
+        self.client.post('/api/emissions/bulk/', [
+            make_record(f'Company {i}', year, 'Energy', 100, 50 + i)
+            for i in range(5) for year in range(2014, 2024)
+        ], format='json')
+
+        # 2019 to 2021 records of the sector, and the 2020 and 2021 sector metrics
+        with RowCounter() as counter:
+            refresh_metrics([('Company 0', 2020, 'Energy')])
+        self.assertLessEqual(counter.rows, 3 * 5 + 2)
+
+    def test_list_endpoint(self):
+        """Test that listing records (with their metrics) is a single query"""
+        self.import_csv(50)
+
+        with self.assertQueryBudget(1, max_rows=50):
+            response = self.client.get('/api/emissions/')
+        self.assertEqual(len(response.data), 50)
+
+    def test_retrieve_endpoint(self):
+        """Test that retrieving a record (with its metrics) is a single query"""
+        record = EmissionRecord.objects.create(
+            company='Company A', year=2023, sector='Energy', energy_consumption_mwh=1, co2_emissions_tons=1
+        )
+        with self.assertQueryBudget(1, max_rows=1):
+            self.client.get(f'/api/emissions/{record.id}/')
+
+    def test_changes_endpoint(self):
+        """Test that the change feed reads the cursor plus one query per kind of change"""
+        self.import_csv(50)
+
+        with self.assertQueryBudget(2, max_rows=50 + 1):
+            cursor = self.client.get('/api/emissions/changes/').data['cursor']
+        with self.assertQueryBudget(3, max_rows=1):
+            self.client.get('/api/emissions/changes/', {'since': cursor})
+        # Pages fetch limit + 1 changes of each kind to know whether there are more
+        with self.assertQueryBudget(3, max_rows=2 * (10 + 1) + 1):
+            self.client.get('/api/emissions/changes/', {'limit': 10, 'since': 1})
+
+    def test_sector_metrics_endpoint(self):
+        """Test that sector metrics are read from their table in a single query"""
+        self.import_csv(50)
+
+        with self.assertQueryBudget(1, max_rows=5):
+            response = self.client.get('/api/emissions/sector_metrics/')
+        self.assertEqual(len(response.data), 5)
+
+
+class ProfilingMiddlewareTestCase(SimpleTestCase):
+    """Test cases for the opt-in slow request profiler"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.directory = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def middleware(self, **overrides):
+        options = {
+            'PROFILING': True,
+            'PROFILING_ALL_REQUESTS': False,
+            'PROFILING_SLOW_MS': 0,
+            'PROFILING_DIR': self.directory,
+            'PROFILER': 'cprofile',
+            **overrides,
+        }
+        self.enterContext(override_settings(**options))
+        return ProfilingMiddleware(lambda request: HttpResponse())
+
+    def test_disabled_by_default(self):
+        """Test that the middleware is left out unless PROFILING is on"""
+        with self.assertRaises(MiddlewareNotUsed):
+            self.middleware(PROFILING=False)
+
+    def test_profiles_requests_with_header(self):
+        """Test that only requests sent with the X-Profile header are profiled and dumped"""
+        middleware = self.middleware()
+
+        response = middleware(self.factory.get('/api/emissions/'))
+        self.assertNotIn(PROFILE_FILE_HEADER, response)
+
+        response = middleware(self.factory.get('/api/emissions/', HTTP_X_PROFILE='1'))
+        profile = self.directory / response[PROFILE_FILE_HEADER]
+        self.assertTrue(profile.exists())
+        self.assertIn('GET-api-emissions', profile.name)
+
+    def test_fast_requests_are_not_dumped(self):
+        """Test that requests faster than PROFILING_SLOW_MS are not written to disk"""
+        middleware = self.middleware(PROFILING_ALL_REQUESTS=True, PROFILING_SLOW_MS=60_000)
+
+        response = middleware(self.factory.get('/api/emissions/'))
+
+        self.assertNotIn(PROFILE_FILE_HEADER, response)
+        self.assertEqual(list(self.directory.iterdir()), [])
@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import EmissionRecordViewSet
+from .views import EmissionRecordViewSet, emission_changes_stream
 
 router = DefaultRouter()
 router.register(r'emissions', EmissionRecordViewSet, basename='emission')
 
 urlpatterns = [
+    path('emissions/changes/stream/', emission_changes_stream, name='emission-changes-stream'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,27 +1,104 @@
 from rest_framework import viewsets, filters, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
-from .models import EmissionRecord
-from .serializers import EmissionRecordSerializer
-from .csv_config import REQUIRED_HEADERS, CSV_TO_MODEL_MAPPING, FIELD_PARSERS
+from django.http import StreamingHttpResponse
+from .routers import pin_to_primary
+from .models import ChangeSequence, EmissionRecord, EmissionRecordTombstone, SectorYearMetrics
+from .serializers import EmissionRecordSerializer, SectorYearMetricsSerializer
+import asyncio
 import csv
 import io
+import json
+import time
+
+# The import pipeline (csv_config, importer, metrics) is imported in the write
+# endpoints only, so workers that just serve reads never load it
+
+# Content types accepted as newline-delimited JSON by the bulk endpoint
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+# Page size limits of the change feed
+CHANGES_DEFAULT_LIMIT = 1000
+CHANGES_MAX_LIMIT = 10000
+
+# Seconds between change checks and between keep-alive comments of the event stream
+CHANGES_STREAM_POLL_INTERVAL = 1
+CHANGES_STREAM_KEEP_ALIVE = 15
+# Seconds after which an event stream ends and frees its worker thread
+CHANGES_STREAM_MAX_LIFETIME = 300
+
+# Errors after which a dry run stops reading the file, unless ?max_errors= is given
+DRY_RUN_MAX_ERRORS = 1000
+
+# Characters of the streamed error report buffered before a chunk is sent
+ERROR_REPORT_CHUNK_SIZE = 64 * 1024
+
+
+def reject_json_constant(constant):
+    """parse_constant hook refusing the NaN and Infinity extensions of json.loads"""
+    raise ValueError(f"{constant} is not a valid JSON value")
+
 
 class EmissionRecordViewSet(viewsets.ModelViewSet):
-    queryset = EmissionRecord.objects.all()
+    queryset = EmissionRecord.objects.select_related('metrics')
     serializer_class = EmissionRecordSerializer
 
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ["company", "sector"]
-    ordering_fields = ["year", "energy_consumption_mwh", "co2_emissions_tons"]
+    ordering_fields = [
+        "year",
+        "energy_consumption_mwh",
+        "co2_emissions_tons",
+        "metrics__emission_intensity",
+        "metrics__intensity_percentile",
+    ]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # ?outliers=true only lists the records flagged as outliers within their sector
+        if self.request.query_params.get('outliers') in ('true', '1'):
+            queryset = queryset.filter(metrics__is_outlier=True)
+        return queryset
+
+    def perform_create(self, serializer):
+        from .metrics import refresh_metrics
+        with transaction.atomic():
+            record = serializer.save()
+            refresh_metrics([record.unique_key], stamped_ids={record.pk})
+
+    def perform_update(self, serializer):
+        from .metrics import refresh_metrics
+        with transaction.atomic():
+            previous_key = serializer.instance.unique_key
+            record = serializer.save()
+            refresh_metrics([previous_key, record.unique_key], stamped_ids={record.pk})
+            # get_object() loaded the metrics along with the record, drop them for the response
+            record.refresh_from_db()
+
+    def perform_destroy(self, instance):
+        from .metrics import refresh_metrics
+        with transaction.atomic():
+            key = instance.unique_key
+            instance.delete()
+            refresh_metrics([key])
 
     @action(detail=False, methods=['post'])
     def import_csv(self, request):
         """
         Import emission records from CSV file
         Expected CSV columns are defined in csv_config.REQUIRED_HEADERS
+
+        ?dry_run=1 only validates the file and never touches the database,
+        ?report=csv (with dry_run) streams every error as a CSV file and
+        ?max_errors=N stops reading the file after N errors. An import that
+        hits max_errors is rejected without writing anything.
         """
+        from .csv_config import REQUIRED_HEADERS, CSV_TO_MODEL_MAPPING
+        from .importer import ImportReport, add_row, upsert_records
+
         csv_file = request.FILES.get('file')
         
         if not csv_file:
@@ -35,12 +112,32 @@ class EmissionRecordViewSet(viewsets.ModelViewSet):
                 {"error": "File must be a CSV"},
                 status=status.HTTP_400_BAD_REQUEST
             )
+
+        dry_run = request.query_params.get('dry_run') in ('true', '1')
+        stream_report = request.query_params.get('report') == 'csv'
+        if stream_report and not dry_run:
+            return Response(
+                {"error": "report=csv is only available with dry_run"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            max_errors = request.query_params.get('max_errors')
+            if max_errors is not None:
+                max_errors = int(max_errors)
+            elif dry_run and not stream_report:
+                # A downloaded report holds every error unless asked otherwise
+                max_errors = DRY_RUN_MAX_ERRORS
+        except ValueError:
+            max_errors = 0
+        if max_errors is not None and max_errors < 1:
+            return Response(
+                {"error": "max_errors must be a positive integer"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
         try:
-            # Read and decode the CSV file
-            decoded_file = csv_file.read().decode('utf-8-sig')
-            io_string = io.StringIO(decoded_file)
-            reader = csv.DictReader(io_string)
+            # Decode the CSV file while reading it instead of loading it whole
+            reader = csv.DictReader(io.TextIOWrapper(csv_file, encoding='utf-8-sig', newline=''))
             
             if not reader.fieldnames:
                 return Response(
@@ -57,78 +154,69 @@ class EmissionRecordViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Collect records for bulk operations
-            records_to_create = []
-            records_to_update = []
-            existing_records = {}
-            errors = []
+            # Errors are reported against the CSV column, not the model field
+            columns = {model_field: csv_header for csv_header, model_field in CSV_TO_MODEL_MAPPING.items()}
+            report = ImportReport(columns=columns, max_errors=max_errors)
             
             # Parse all rows first and handle duplicates within CSV
             parsed_rows = {}  # Use dict to handle duplicates: key = (company, year, sector)
+            rows = (
+                (row_num, {
+                    model_field: row.get(csv_header) or ''
+                    for csv_header, model_field in CSV_TO_MODEL_MAPPING.items()
+                })
+                for row_num, row in enumerate(reader, start=2)
+            )
+
+            if stream_report:
+                response = StreamingHttpResponse(
+                    self._stream_error_report(rows, parsed_rows, report),
+                    content_type='text/csv'
+                )
+                report_name = csv_file.name[:-4].replace('"', '')
+                response['Content-Disposition'] = f'attachment; filename="{report_name}-errors.csv"'
+                return response
+            
+            row_count = 0
+            for row_num, row_data in rows:
+                add_row(parsed_rows, row_data, row_num, report, keep_rows=not dry_run)
+                row_count += 1
+                if report.aborted:
+                    break
+            
+            summary = {
+                "errors": report.messages(),
+                "error_count": report.total,
+                "error_counts": dict(report.counts),
+            }
+            
+            if dry_run:
+                # Structured errors instead of the messages of a regular import
+                return Response({
+                    "message": (
+                        f"CSV validation stopped after {report.total} errors" if report.aborted
+                        else "CSV validation completed"
+                    ),
+                    "dry_run": True,
+                    # Duplicates are resolved by the import, they do not make a file invalid
+                    "valid": report.total == report.warnings and bool(parsed_rows),
+                    "aborted": report.aborted,
+                    "rows_checked": row_count,
+                    "valid_rows": len(parsed_rows),
+                    **summary,
+                    "warning_count": report.warnings,
+                    "errors": report.samples,
+                })
             
-            for row_num, row in enumerate(reader, start=2):
-                try:
-                    # Extract and trim data using configuration mapping
-                    row_data = {
-                        model_field: row.get(csv_header, '').strip()
-                        for csv_header, model_field in CSV_TO_MODEL_MAPPING.items()
-                    }
-                    
-                    # Validate required fields are not empty
-                    if not all(row_data.values()):
-                        errors.append(f"Row {row_num}: Missing required fields")
-                        continue
-                    
-                    # Parse and validate data types using configured parsers
-                    try:
-                        parsed_data = {'row_num': row_num}
-                        for field, value in row_data.items():
-                            if field in FIELD_PARSERS:
-                                parsed_data[field] = FIELD_PARSERS[field](value)
-                            else:
-                                parsed_data[field] = value
-                        
-                        # Create unique key for this record
-                        unique_key = (parsed_data['company'], parsed_data['year'], parsed_data['sector'])
-                        
-                        # Check for duplicates within the CSV itself
-                        if unique_key in parsed_rows:
-                            existing_row = parsed_rows[unique_key]
-                            # Compare emissions and energy consumption to keep the highest
-                            existing_emissions = float(existing_row['co2_emissions_tons'])
-                            new_emissions = float(parsed_data['co2_emissions_tons'])
-                            existing_energy = float(existing_row['energy_consumption_mwh'])
-                            new_energy = float(parsed_data['energy_consumption_mwh'])
-                            
-                            # Keep the row with highest total impact (emissions + energy)
-                            existing_total = existing_emissions + existing_energy
-                            new_total = new_emissions + new_energy
-                            
-                            if new_total > existing_total:
-                                replaced_row = existing_row['row_num']
-                                errors.append(
-                                    f"Row {replaced_row}: Duplicate entry for {parsed_data['company']} "
-                                    f"(year {parsed_data['year']}, sector {parsed_data['sector']}). "
-                                    f"Keeping row {row_num} with higher emissions/energy values "
-                                    f"(new total: {new_total:.2f} vs existing: {existing_total:.2f})"
-                                )
-                                parsed_rows[unique_key] = parsed_data
-                            else:
-                                errors.append(
-                                    f"Row {row_num}: Duplicate entry for {parsed_data['company']} "
-                                    f"(year {parsed_data['year']}, sector {parsed_data['sector']}). "
-                                    f"Keeping row {existing_row['row_num']} with higher emissions/energy values "
-                                    f"(existing total: {existing_total:.2f} vs new: {new_total:.2f})"
-                                )
-                        else:
-                            parsed_rows[unique_key] = parsed_data
-                        
-                    except ValueError as e:
-                        errors.append(f"Row {row_num}: Invalid data format - {str(e)}")
-                        continue
-                    
-                except Exception as e:
-                    errors.append(f"Row {row_num}: {str(e)}")
+            if report.aborted:
+                return Response(
+                    {
+                        "error": f"Import aborted after {report.total} errors, nothing was written",
+                        "aborted": True,
+                        **summary
+                    },
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             
             # Convert dict to list for further processing
             parsed_rows_list = list(parsed_rows.values())
@@ -137,73 +225,18 @@ class EmissionRecordViewSet(viewsets.ModelViewSet):
                 return Response(
                     {
                         "error": "No valid rows to process",
-                        "errors": errors
+                        **summary
                     },
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Use transaction for atomicity
-            with transaction.atomic():
-                # Get existing records for comparison
-                company_year_sector_tuples = [
-                    (row['company'], row['year'], row['sector']) 
-                    for row in parsed_rows_list
-                ]
-                existing_records_qs = EmissionRecord.objects.filter(
-                    company__in=[t[0] for t in company_year_sector_tuples],
-                    year__in=[t[1] for t in company_year_sector_tuples],
-                    sector__in=[t[2] for t in company_year_sector_tuples]
-                )
-                
-                # Create a lookup dict for existing records
-                for record in existing_records_qs:
-                    existing_records[(record.company, record.year, record.sector)] = record
-                
-                # Separate into create and update operations
-                for row_data in parsed_rows_list:
-                    key = (row_data['company'], row_data['year'], row_data['sector'])
-                    
-                    if key in existing_records:
-                        # Update existing record only if values are different
-                        existing_record = existing_records[key]
-                        needs_update = (
-                            float(existing_record.energy_consumption_mwh) != float(row_data['energy_consumption_mwh']) or
-                            float(existing_record.co2_emissions_tons) != float(row_data['co2_emissions_tons'])
-                        )
-                        if needs_update:
-                            existing_record.energy_consumption_mwh = row_data['energy_consumption_mwh']
-                            existing_record.co2_emissions_tons = row_data['co2_emissions_tons']
-                            records_to_update.append(existing_record)
-                    else:
-                        # Create new record
-                        records_to_create.append(EmissionRecord(
-                            company=row_data['company'],
-                            year=row_data['year'],
-                            sector=row_data['sector'],
-                            energy_consumption_mwh=row_data['energy_consumption_mwh'],
-                            co2_emissions_tons=row_data['co2_emissions_tons']
-                        ))
-                
-                # Perform bulk operations
-                created_count = 0
-                updated_count = 0
-                
-                if records_to_create:
-                    EmissionRecord.objects.bulk_create(records_to_create)
-                    created_count = len(records_to_create)
-                
-                if records_to_update:
-                    EmissionRecord.objects.bulk_update(
-                        records_to_update,
-                        ['energy_consumption_mwh', 'co2_emissions_tons']
-                    )
-                    updated_count = len(records_to_update)
+            created_count, updated_count = upsert_records(parsed_rows_list)
             
             return Response({
                 "message": "CSV import completed successfully",
                 "created": created_count,
                 "updated": updated_count,
-                "errors": errors,
+                **summary,
                 "total_processed": created_count + updated_count
             }, status=status.HTTP_201_CREATED if created_count > 0 else status.HTTP_200_OK)
             
@@ -211,4 +244,254 @@ class EmissionRecordViewSet(viewsets.ModelViewSet):
             return Response(
                 {"error": f"Failed to process CSV: {str(e)}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            )
+
+    @staticmethod
+    def _stream_error_report(rows, parsed_rows, report):
+        """
+        Validate rows while streaming every error as a row, column, code, message
+        CSV, flushing whenever ERROR_REPORT_CHUNK_SIZE characters were buffered.
+        The headers are already sent when reading the file fails (e.g. it is not
+        valid UTF-8), so the failure is reported as a last unexpected row.
+        """
+        from .importer import UNEXPECTED, add_row
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['row', 'column', 'code', 'message'])
+        report.sink = lambda error: writer.writerow(
+            [error['row'], error['column'] or '', error['code'], error['message']]
+        )
+        try:
+            for row_num, row_data in rows:
+                add_row(parsed_rows, row_data, row_num, report, keep_rows=False)
+                if buffer.tell() >= ERROR_REPORT_CHUNK_SIZE:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                if report.aborted:
+                    break
+        except Exception as e:
+            writer.writerow(['', '', UNEXPECTED, f"Failed to process CSV: {str(e)}"])
+        yield buffer.getvalue()
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Create or update emission records from a JSON or NDJSON batch.
+        JSON bodies are a list of records (or {"records": [...]}), NDJSON bodies
+        hold one record per line and are parsed while streaming the request.
+        Records use the model field names and share the CSV import semantics.
+        """
+        from .importer import ImportReport, add_row, upsert_records
+
+        report = ImportReport(label='Record')
+        parsed_rows = {}  # Use dict to handle duplicates: key = (company, year, sector)
+        
+        if request.content_type.split(';')[0].strip() in NDJSON_CONTENT_TYPES:
+            records = self._iter_ndjson(request.stream, report)
+        else:
+            records = request.data
+            if isinstance(records, dict):
+                records = records.get('records')
+            if not isinstance(records, list):
+                return Response(
+                    {"error": "Expected a list of records"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            records = enumerate(records, start=1)
+        
+        for record_num, record in records:
+            add_row(parsed_rows, record, record_num, report)
+        
+        parsed_rows_list = list(parsed_rows.values())
+        summary = {
+            "errors": report.messages(),
+            "error_count": report.total,
+            "error_counts": dict(report.counts),
+        }
+        
+        if not parsed_rows_list:
+            return Response(
+                {
+                    "error": "No valid records to process",
+                    **summary
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            created_count, updated_count = upsert_records(parsed_rows_list)
+        except Exception as e:
+            return Response(
+                {"error": f"Failed to process records: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        
+        return Response({
+            "message": "Bulk import completed successfully",
+            "created": created_count,
+            "updated": updated_count,
+            **summary,
+            "total_processed": created_count + updated_count
+        }, status=status.HTTP_201_CREATED if created_count > 0 else status.HTTP_200_OK)
+
+    @staticmethod
+    def _iter_ndjson(stream, report):
+        """Yield (record_num, record) for each non-blank line of an NDJSON stream"""
+        from .importer import INVALID_JSON
+
+        if stream is None:
+            return
+        for record_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield record_num, json.loads(line, parse_constant=reject_json_constant)
+            except ValueError as e:
+                report.add(record_num, INVALID_JSON, f"Invalid JSON - {str(e)}")
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """
+        Return the records written and deleted after the ?since=<cursor> sequence.
+        Without a cursor every record is returned. Clients store the returned
+        cursor and pass it on the next call, paging while has_more is true.
+        When reset is true the client must drop its copy and use this response.
+        """
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit', CHANGES_DEFAULT_LIMIT)), CHANGES_MAX_LIMIT)
+        except ValueError:
+            return Response(
+                {"error": "since and limit must be integers"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if since < 0 or limit < 1:
+            return Response(
+                {"error": "since must be >= 0 and limit >= 1"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Read the cursor first, anything committed afterwards is picked up by the next call
+        current = ChangeSequence.current()
+        if since > current:
+            # The replica may lag behind the database the client last synced from,
+            # check the primary and read the rest of the page from it as well
+            pin_to_primary()
+            current = ChangeSequence.current()
+        # A cursor ahead of the primary comes from a reset database, the client must resync
+        reset = since > current
+        if reset:
+            since = 0
+        
+        records = EmissionRecord.objects.select_related('metrics').order_by('sequence')
+        tombstones = EmissionRecordTombstone.objects.order_by('sequence')
+        if since:
+            records = records.filter(sequence__gt=since)
+            tombstones = tombstones.filter(sequence__gt=since)
+        else:
+            # Deletes before the first sync are irrelevant to a client with no copy
+            tombstones = tombstones.none()
+        
+        changes = sorted(
+            [(record.sequence, record) for record in records[:limit + 1]] +
+            [(tombstone.sequence, tombstone) for tombstone in tombstones[:limit + 1]],
+            key=lambda change: change[0]
+        )
+        has_more = len(changes) > limit
+        if has_more:
+            changes = changes[:limit]
+            cursor = changes[-1][0]
+        else:
+            cursor = max([since, current] + [sequence for sequence, _ in changes])
+        
+        return Response({
+            "cursor": cursor,
+            "has_more": has_more,
+            "reset": reset,
+            "changed": EmissionRecordSerializer(
+                [change for _, change in changes if isinstance(change, EmissionRecord)], many=True
+            ).data,
+            "deleted": [
+                {
+                    "id": change.record_id,
+                    "company": change.company,
+                    "year": change.year,
+                    "sector": change.sector,
+                }
+                for _, change in changes if isinstance(change, EmissionRecordTombstone)
+            ],
+        })
+
+
+    @action(detail=False, methods=['get'])
+    def sector_metrics(self, request):
+        """
+        Yearly totals, emission intensity and YoY change per sector,
+        optionally filtered with ?sector=<name>.
+        """
+        queryset = SectorYearMetrics.objects.all()
+        sector = request.query_params.get('sector')
+        if sector:
+            queryset = queryset.filter(sector=sector)
+        return Response(SectorYearMetricsSerializer(queryset, many=True).data)
+
+def emission_changes_stream(request):
+    """
+    Server-Sent Events stream that emits a "change" event carrying the new
+    cursor whenever records are written or deleted (e.g. an import commits).
+    Clients react by fetching /api/emissions/changes/?since=<their cursor>.
+
+    Served over ASGI the stream is an async generator that stays open. Over
+    WSGI a stream holds a worker thread, so it ends after
+    CHANGES_STREAM_MAX_LIFETIME seconds. EventSource clients reconnect on
+    their own, resuming from the Last-Event-ID header.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    try:
+        cursor = int(last_event_id) if last_event_id else None
+    except ValueError:
+        cursor = None
+    if cursor is None:
+        cursor = ChangeSequence.current()
+
+    def change_event(cursor):
+        return f"id: {cursor}\nevent: change\ndata: {json.dumps({'cursor': cursor})}\n\n"
+
+    async def async_event_stream(cursor):
+        idle = 0
+        while True:
+            current = await sync_to_async(ChangeSequence.current)()
+            if current > cursor:
+                cursor = current
+                idle = 0
+                yield change_event(cursor)
+            else:
+                idle += CHANGES_STREAM_POLL_INTERVAL
+                if idle >= CHANGES_STREAM_KEEP_ALIVE:
+                    idle = 0
+                    yield ": keep-alive\n\n"
+            await asyncio.sleep(CHANGES_STREAM_POLL_INTERVAL)
+
+    def event_stream(cursor):
+        idle = 0
+        for _ in range(CHANGES_STREAM_MAX_LIFETIME // CHANGES_STREAM_POLL_INTERVAL):
+            current = ChangeSequence.current()
+            if current > cursor:
+                cursor = current
+                idle = 0
+                yield change_event(cursor)
+            else:
+                idle += CHANGES_STREAM_POLL_INTERVAL
+                if idle >= CHANGES_STREAM_KEEP_ALIVE:
+                    idle = 0
+                    yield ": keep-alive\n\n"
+            time.sleep(CHANGES_STREAM_POLL_INTERVAL)
+
+    # A sync iterator would be read whole before anything is sent over ASGI
+    stream = async_event_stream(cursor) if isinstance(request, ASGIRequest) else event_stream(cursor)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,7 +1,24 @@
 #!/bin/bash
+set -e
 
-# Run migrations
-python manage.py migrate
+# One-off migration job, run once per deploy instead of in every replica
+# (see the migrate service in docker-compose.yaml)
+# Records without derived metrics (e.g. written before they existed) get them afterwards
+if [ "$1" = "migrate" ]; then
+    python manage.py migrate --noinput
+    exec python manage.py refresh_metrics --missing
+fi
+
+# Single container setups can still migrate on start
+if [ "${RUN_MIGRATIONS}" = "True" ]; then
+    python manage.py migrate --noinput
+    python manage.py refresh_metrics --missing
+fi
 
 # Start server
-python manage.py runserver 0.0.0.0:${DJANGO_PORT}
\ No newline at end of file
+if [ "${DJANGO_SERVER}" = "gunicorn" ]; then
+    # Pre-forked workers, configured in gunicorn.conf.py
+    exec gunicorn
+else
+    exec python manage.py runserver 0.0.0.0:${DJANGO_PORT}
+fi
\ No newline at end of file
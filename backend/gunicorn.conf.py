@@ -0,0 +1,30 @@
+"""
+Gunicorn configuration, used when the container starts with DJANGO_SERVER=gunicorn.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('DJANGO_PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+# Threads per worker. An open event stream (/api/emissions/changes/stream/) holds
+# one until it ends after CHANGES_STREAM_MAX_LIFETIME and the client reconnects
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+
+# Load Django in the master once and fork the workers from it, so they start
+# instantly and share the memory pages of the loaded code
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True') == 'True'
+wsgi_app = 'tech2C_challenge.wsgi:application'
+
+
+def when_ready(server):
+    # Still in the master before forking: load the URLconf, which imports the
+    # views and serializers, instead of doing it on each worker's first request
+    if not server.cfg.preload_app:
+        return
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+
+
+def post_fork(server, worker):
+    # Database connections (and pools) must never be shared between processes
+    from django.db import connections
+    connections.close_all()
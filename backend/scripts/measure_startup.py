@@ -0,0 +1,62 @@
+"""
+Measure the cold start of a worker: time from interpreter start to the first
+served request and the resident memory afterwards, for each settings module.
+
+Usage (from the backend directory, with the database migrated):
+    python scripts/measure_startup.py tech2C_challenge.settings tech2C_challenge.settings_api
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Runs in a fresh interpreter, so imports are part of the measurement
+WORKER = """
+import json, os, sys, time
+start = float(sys.argv[1])
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from io import BytesIO
+statuses = []
+environ = {
+    'REQUEST_METHOD': 'GET', 'PATH_INFO': '/api/emissions/', 'QUERY_STRING': '',
+    'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http',
+    'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr,
+}
+b''.join(application(environ, lambda status, headers: statuses.append(status)))
+elapsed = time.time() - start
+times = os.times()
+with open('/proc/self/status') as status:
+    rss_kb = next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+print(json.dumps({'status': statuses[0], 'seconds': elapsed, 'cpu_seconds': times.user + times.system, 'rss_mb': rss_kb / 1024, 'modules': len(sys.modules)}))
+"""
+
+
+def measure(settings_module, runs=20):
+    results = []
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings_module}
+    env.setdefault('ALLOWED_HOSTS', 'testserver')
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', WORKER, str(time.time())],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    for settings_module in sys.argv[1:] or ['tech2C_challenge.settings', 'tech2C_challenge.settings_api']:
+        results = measure(settings_module)
+        seconds = min(result['seconds'] for result in results)
+        cpu_seconds = min(result['cpu_seconds'] for result in results)
+        rss_mb = sorted(result['rss_mb'] for result in results)[len(results) // 2]
+        print(
+            f"{settings_module:<32} first request {seconds * 1000:6.0f} ms (CPU {cpu_seconds * 1000:4.0f} ms)  "
+            f"RSS {rss_mb:5.1f} MB  modules {results[-1]['modules']}  (best of {len(results)})"
+        )
+
+
+if __name__ == '__main__':
+    main()
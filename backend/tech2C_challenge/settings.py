@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'dashboard.middleware.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -54,6 +55,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'dashboard.middleware.ReplicaStickinessMiddleware',
 ]
 
 ROOT_URLCONF = 'tech2C_challenge.urls'
@@ -79,17 +81,53 @@ WSGI_APPLICATION = 'tech2C_challenge.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+def database_settings(host, port):
+    return {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': os.getenv('POSTGRES_DB'),
         'USER': os.getenv('POSTGRES_USER'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
-        'HOST': os.getenv('POSTGRES_HOST'),
-        'PORT': os.getenv('POSTGRES_PORT'),
+        'HOST': host,
+        'PORT': port,
+        # Pooled connections (psycopg 3), replaces one new connection per request
+        'OPTIONS': {
+            'pool': {
+                'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', 2)),
+                'max_size': int(os.getenv('POSTGRES_POOL_MAX_SIZE', 10)),
+            },
+        } if os.getenv('POSTGRES_POOL', 'True') == 'True' else {},
     }
+
+
+DATABASES = {
+    'default': database_settings(os.getenv('POSTGRES_HOST'), os.getenv('POSTGRES_PORT')),
 }
 
+# Read replicas as a comma separated list of host[:port], e.g. "replica1:5432,replica2"
+# Tests mirror them to the primary, so no replica is needed to run them
+for index, replica in enumerate(filter(None, os.getenv('POSTGRES_REPLICA_HOSTS', '').split(',')), start=1):
+    replica_host, _, replica_port = replica.strip().partition(':')
+    DATABASES[f'replica_{index}'] = {
+        **database_settings(replica_host, replica_port or os.getenv('POSTGRES_PORT')),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+DATABASE_ROUTERS = ['dashboard.routers.PrimaryReplicaRouter']
+
+# Seconds a client keeps reading from the primary after it wrote, covers the replication lag
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 5))
+
+
+# Opt-in profiling of slow requests (see dashboard.middleware.ProfilingMiddleware)
+PROFILING = os.getenv('PROFILING', 'False') == 'True'
+# Profile every request instead of only the ones sent with the X-Profile header
+PROFILING_ALL_REQUESTS = os.getenv('PROFILING_ALL_REQUESTS', 'False') == 'True'
+PROFILING_SLOW_MS = int(os.getenv('PROFILING_SLOW_MS', 200))
+PROFILING_DIR = os.getenv('PROFILING_DIR', BASE_DIR / 'profiles')
+# cprofile or pyinstrument (pip install pyinstrument)
+PROFILER = os.getenv('PROFILER', 'cprofile')
 
 
 # Password validation
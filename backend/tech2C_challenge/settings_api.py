@@ -0,0 +1,41 @@
+"""
+Lean API-only settings for tech2C_challenge workers.
+
+Extends the default settings, dropping what a JSON API worker never uses:
+the admin, sessions, messages, static files, templates and the browsable
+API renderer. Select it with DJANGO_SETTINGS_MODULE=tech2C_challenge.settings_api.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'dashboard',
+    'corsheaders',
+]
+
+MIDDLEWARE = [
+    'dashboard.middleware.ProfilingMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'dashboard.middleware.ReplicaStickinessMiddleware',
+]
+
+ROOT_URLCONF = 'tech2C_challenge.urls_api'
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
+
+# JSON only, no authentication (the API is public) so django.contrib.auth is not needed
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.AllowAny'],
+    'UNAUTHENTICATED_USER': None,
+}
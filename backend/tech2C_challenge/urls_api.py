@@ -0,0 +1,9 @@
+"""
+URL configuration of the lean API-only settings (tech2C_challenge.settings_api),
+the same API without the admin and the browsable API login views.
+"""
+from django.urls import path, include
+
+urlpatterns = [
+    path("api/", include("dashboard.urls")),
+]
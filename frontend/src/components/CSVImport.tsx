@@ -7,6 +7,8 @@ interface ImportResult {
   created: number;
   updated: number;
   errors: string[];
+  error_count: number;
+  error_counts: Record<string, number>;
   total_processed: number;
 }
 
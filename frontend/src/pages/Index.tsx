@@ -37,7 +37,7 @@ const Index = () => {
     setLoading(true);
     setError(null);
     try {
-      const records: EmissionRecord[] = await api.getAllEmissions();
+      const records: EmissionRecord[] = await api.syncEmissions();
       
       // Transform API data to match your chart format
       const transformedData: EmissionData[] = records.map(record => ({
@@ -212,7 +212,7 @@ const Index = () => {
                   {importResult.errors.length > 0 && (
                     <div className="bg-orange-50 p-3 rounded-lg border border-orange-200">
                       <p className="text-sm font-medium text-orange-900">Errors</p>
-                      <p className="text-2xl font-bold text-orange-600">{importResult.errors.length}</p>
+                      <p className="text-2xl font-bold text-orange-600">{importResult.error_count}</p>
                     </div>
                   )}
                 </div>
@@ -221,6 +221,11 @@ const Index = () => {
                 {importResult.errors.length > 0 && (
                   <div className="bg-orange-50 p-4 rounded-lg border border-orange-200">
                     <p className="font-semibold text-orange-900 mb-2">Warnings/Errors:</p>
+                    {importResult.error_count > importResult.errors.length && (
+                      <p className="text-sm text-orange-800 mb-2">
+                        Showing the first {importResult.errors.length} of {importResult.error_count}
+                      </p>
+                    )}
                     <ul className="text-sm text-orange-800 space-y-1 max-h-40 overflow-y-auto">
                       {importResult.errors.map((err, idx) => (
                         <li key={idx} className="flex gap-2">
@@ -10,13 +10,42 @@ export interface EmissionRecord {
   sector: string;
   energy_consumption_mwh: string;
   co2_emissions_tons: string;
+  sequence: number;
+  updated_at: string;
+  metrics: EmissionMetrics | null;
 }
 
+export interface EmissionMetrics {
+  emission_intensity: number | null;
+  intensity_percentile: number | null;
+  intensity_zscore: number | null;
+  is_outlier: boolean;
+  emissions_yoy_change: number | null;
+  emissions_yoy_change_pct: number | null;
+}
+
+export interface EmissionChangesResponse {
+  cursor: number;
+  has_more: boolean;
+  reset: boolean;
+  changed: EmissionRecord[];
+  deleted: Pick<EmissionRecord, 'id' | 'company' | 'year' | 'sector'>[];
+}
+
+interface EmissionsSnapshot {
+  cursor: number;
+  records: EmissionRecord[];
+}
+
+const EMISSIONS_SNAPSHOT_KEY = 'emissions-snapshot';
+
 export interface ImportCSVResponse {
   message: string;
   created: number;
   updated: number;
   errors: string[];
+  error_count: number;
+  error_counts: Record<string, number>;
   total_processed: number;
 }
 
@@ -34,6 +63,7 @@ class ApiService {
   async getAllEmissions(): Promise<EmissionRecord[]> {
     const response = await fetch(`${API_BASE_URL}/emissions/`, {
       headers: this.getHeaders(),
+      credentials: 'include', // Keeps reads on the primary right after an import
     });
     
     if (!response.ok) {
@@ -43,6 +73,62 @@ class ApiService {
     return response.json();
   }
 
+  async getEmissionChanges(since = 0): Promise<EmissionChangesResponse> {
+    const response = await fetch(`${API_BASE_URL}/emissions/changes/?since=${since}`, {
+      headers: this.getHeaders(),
+      credentials: 'include',
+    });
+
+    if (!response.ok) {
+      throw new Error('Failed to fetch emission changes');
+    }
+
+    return response.json();
+  }
+
+  // Keeps a local copy of the records and only fetches what changed since the last sync
+  async syncEmissions(): Promise<EmissionRecord[]> {
+    const snapshot = this.loadSnapshot();
+    const records = new Map(snapshot.records.map(record => [record.id, record]));
+    let cursor = snapshot.cursor;
+    let hasMore = true;
+
+    while (hasMore) {
+      const changes = await this.getEmissionChanges(cursor);
+      if (changes.reset) {
+        records.clear();
+      }
+      changes.deleted.forEach(record => records.delete(record.id));
+      changes.changed.forEach(record => records.set(record.id, record));
+      cursor = changes.cursor;
+      hasMore = changes.has_more;
+    }
+
+    const synced = Array.from(records.values());
+    this.saveSnapshot({ cursor, records: synced });
+    return synced;
+  }
+
+  private loadSnapshot(): EmissionsSnapshot {
+    try {
+      const stored = localStorage.getItem(EMISSIONS_SNAPSHOT_KEY);
+      if (stored) {
+        return JSON.parse(stored);
+      }
+    } catch {
+      // Corrupted or unavailable storage, fall back to a full sync
+    }
+    return { cursor: 0, records: [] };
+  }
+
+  private saveSnapshot(snapshot: EmissionsSnapshot) {
+    try {
+      localStorage.setItem(EMISSIONS_SNAPSHOT_KEY, JSON.stringify(snapshot));
+    } catch {
+      // Storage full or unavailable, the next load does a full sync
+    }
+  }
+
   async importCSV(file: File): Promise<ImportCSVResponse> {
     const formData = new FormData();
     formData.append('file', file);
@@ -50,6 +136,7 @@ class ApiService {
     const response = await fetch(`${API_BASE_URL}/emissions/import_csv/`, {
       method: 'POST',
       headers: this.getHeaders(false), // Don't set Content-Type for FormData
+      credentials: 'include',
       body: formData,
     });
 